@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import math
+import os
+import platform
+import shlex
+import signal
+import subprocess
+import sys
+import time
+
+import dbus
+import dbus.bus
+from dbus.mainloop.glib import DBusGMainLoop
+from gi.repository import GLib
+
+from dbus_size import wait_for_name
+
+# Call latency and throughput of the storage demo services in this
+# directory.  A private dbus-daemon is started and each service is run on it
+# in turn (DBUS_SESSION_BUS_ADDRESS for the rust one, DBUS_SYSTEM_BUS_ADDRESS
+# for sd-bus which uses the system bus), then every operation is driven in a
+# closed loop at each concurrency level for --duration seconds.  Latency is
+# measured client side from the call to the reply being handed to us, so it
+# includes the python unmarshalling.
+#
+# ./dbus_bench.py --markdown > result.md
+
+BUS_NAME = "com.blah.storage"
+BLOCK_IFACE = "com.blah.storage.BlockDevice"
+PROPS_IFACE = "org.freedesktop.DBus.Properties"
+OM_IFACE = "org.freedesktop.DBus.ObjectManager"
+BLOCK_PATH = "/com/blah/storage/block/0"
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# name -> (default command, object manager path, Hello signature and args)
+SERVICES = dict(
+    rust=(os.path.join(HERE, "rust/target/release/dbus_test") + " {count}",
+          "/com/blah/storage/block", ('', ())),
+    sd_bus=(os.path.join(HERE, "sd-bus/sd_simple") + " {count}",
+            "/", ('s', ("bench",))),
+)
+
+OPERATIONS = ["GetManagedObjects", "GetAll", "Get", "Hello"]
+
+
+def start_daemon():
+    proc = subprocess.Popen(["dbus-daemon", "--session", "--nofork",
+                             "--print-address=1"],
+                            stdout=subprocess.PIPE, universal_newlines=True)
+    address = proc.stdout.readline().strip()
+    if not address:
+        proc.wait()
+        raise RuntimeError("dbus-daemon failed to start")
+    return proc, address
+
+
+def stop(proc):
+    if proc.poll() is None:
+        proc.send_signal(signal.SIGTERM)
+    proc.wait()
+
+
+def operation_call(op, om_path, hello):
+    """
+    Returns (path, interface, method, signature, args) for op
+    """
+    if op == "GetManagedObjects":
+        return om_path, OM_IFACE, op, '', ()
+    if op == "GetAll":
+        return BLOCK_PATH, PROPS_IFACE, op, 's', (BLOCK_IFACE,)
+    if op == "Get":
+        return BLOCK_PATH, PROPS_IFACE, op, 'ss', (BLOCK_IFACE, "Name")
+    return (BLOCK_PATH, BLOCK_IFACE, "Hello") + hello
+
+
+def percentile(ordered, p):
+    # Nearest rank
+    if not ordered:
+        return 0.0
+    k = int(math.ceil(p / 100.0 * len(ordered))) - 1
+    k = max(0, min(len(ordered) - 1, k))
+    return ordered[k]
+
+
+class ClosedLoop(object):
+    """
+    Keeps concurrency calls outstanding, re-issuing as each completes until
+    duration has passed, recording the latency of every call.
+    """
+
+    def __init__(self, bus, call, concurrency, duration, timeout):
+        self.bus = bus
+        self.call = call
+        self.concurrency = concurrency
+        self.duration = duration
+        self.timeout = timeout
+        self.latencies = []
+        self.errors = 0
+        self.in_flight = 0
+        self.end = 0.0
+        self.loop = GLib.MainLoop()
+
+    def _issue(self):
+        path, interface, method, sig, args = self.call
+        start = time.monotonic()
+        self.in_flight += 1
+        self.bus.call_async(BUS_NAME, path, interface, method, sig, args,
+                            lambda *_: self._complete(start, False),
+                            lambda e: self._complete(start, True),
+                            timeout=self.timeout)
+
+    def _complete(self, start, error):
+        now = time.monotonic()
+        self.in_flight -= 1
+        if error:
+            self.errors += 1
+        else:
+            self.latencies.append(now - start)
+
+        if now < self.end:
+            self._issue()
+        elif not self.in_flight:
+            self.loop.quit()
+
+    def run(self):
+        start = time.monotonic()
+        self.end = start + self.duration
+        for _ in range(self.concurrency):
+            self._issue()
+        self.loop.run()
+        elapsed = time.monotonic() - start
+
+        ordered = sorted(self.latencies)
+        ms = [v * 1000.0 for v in ordered]
+        return dict(concurrency=self.concurrency, calls=len(ordered),
+                    errors=self.errors,
+                    calls_per_sec=len(ordered) / elapsed if elapsed else 0.0,
+                    p50_ms=percentile(ms, 50), p90_ms=percentile(ms, 90),
+                    p99_ms=percentile(ms, 99), max_ms=ms[-1] if ms else 0.0)
+
+
+def bench_service(name, command, om_path, hello, args, address):
+    env = dict(os.environ, DBUS_SESSION_BUS_ADDRESS=address,
+               DBUS_SYSTEM_BUS_ADDRESS=address)
+    bus = dbus.bus.BusConnection(address, mainloop=DBusGMainLoop())
+    proc = subprocess.Popen(shlex.split(command.format(count=args.objects)),
+                            env=env)
+    rows = []
+    try:
+        wait_for_name(bus, BUS_NAME, proc, args.timeout)
+        for op in args.operations:
+            call = operation_call(op, om_path, hello)
+
+            # Warm up, first calls pay for lazy setup on both ends
+            ClosedLoop(bus, call, 1, 0.0, args.timeout).run()
+
+            for concurrency in args.concurrency:
+                r = ClosedLoop(bus, call, concurrency, args.duration,
+                               args.timeout).run()
+                r.update(service=name, operation=op)
+                rows.append(r)
+                print("%s %s x%d: %.0f calls/s" %
+                      (name, op, concurrency, r['calls_per_sec']),
+                      file=sys.stderr)
+    finally:
+        stop(proc)
+        bus.close()
+    return rows
+
+
+def peak_rates(rows):
+    """
+    Maximum sustained call rate over the concurrency levels, per service and
+    operation
+    """
+    rc = dict()
+    for r in rows:
+        key = (r['service'], r['operation'])
+        if key not in rc or r['calls_per_sec'] > rc[key]['calls_per_sec']:
+            rc[key] = r
+    return [rc[k] for k in sorted(rc)]
+
+
+def print_tables(rows):
+    print("| service | operation | concurrency | calls/s | p50 ms | p90 ms "
+          "| p99 ms | max ms | errors |")
+    print("|---|---|---:|---:|---:|---:|---:|---:|---:|")
+    for r in rows:
+        print("| %s | %s | %d | %.0f | %.3f | %.3f | %.3f | %.3f | %d |" %
+              (r['service'], r['operation'], r['concurrency'],
+               r['calls_per_sec'], r['p50_ms'], r['p90_ms'], r['p99_ms'],
+               r['max_ms'], r['errors']))
+
+    print("\n### Maximum sustained call rate\n")
+    print("| service | operation | calls/s | at concurrency |")
+    print("|---|---|---:|---:|")
+    for r in peak_rates(rows):
+        print("| %s | %s | %.0f | %d |" %
+              (r['service'], r['operation'], r['calls_per_sec'],
+               r['concurrency']))
+
+
+def metadata(args):
+    return dict(host=platform.node(), kernel=platform.release(),
+                machine=platform.machine(),
+                python=platform.python_version(),
+                cpus=os.cpu_count(), objects=args.objects,
+                duration=args.duration)
+
+
+def print_markdown(rows, args):
+    print("# D-Bus call benchmarks (dbus-rs vs sd-bus)\n")
+    m = metadata(args)
+    print("**Host:** %s  \n**Machine/CPUs:** %s/%d  \n**Kernel:** %s  \n"
+          "**Python:** %s  \n**Objects:** %d  \n**Duration per run:** %.1fs"
+          "  \n" % (m['host'], m['machine'], m['cpus'], m['kernel'],
+                    m['python'], m['objects'], m['duration']))
+    print("## Latency and throughput\n")
+    print_tables(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="D-Bus call latency and throughput of the dbus_memory "
+                    "demo services on a private bus")
+    parser.add_argument("--service", action="append", default=[],
+                        metavar="NAME[=COMMAND]",
+                        help="service to run, one of %s, optionally with the "
+                             "command line to start it, {count} is replaced "
+                             "with --objects (default: all that are built)" %
+                             ", ".join(sorted(SERVICES)))
+    parser.add_argument("--objects", type=int, default=10000,
+                        help="objects each service publishes "
+                             "(default: %(default)s)")
+    parser.add_argument("--operations", default=",".join(OPERATIONS),
+                        help="comma separated subset of %(default)s")
+    parser.add_argument("--concurrency", default="1,4,16,64",
+                        help="comma separated outstanding call counts "
+                             "(default: %(default)s)")
+    parser.add_argument("--duration", type=float, default=2.0,
+                        help="seconds per run (default: %(default)s)")
+    parser.add_argument("--timeout", type=float, default=60.0,
+                        help="call and service start timeout in seconds "
+                             "(default: %(default)s)")
+    output = parser.add_mutually_exclusive_group()
+    output.add_argument("--json", action="store_true")
+    output.add_argument("--markdown", action="store_true")
+    args = parser.parse_args()
+
+    try:
+        args.concurrency = [int(c) for c in args.concurrency.split(',')]
+    except ValueError:
+        parser.error("invalid --concurrency %s" % args.concurrency)
+    args.operations = args.operations.split(',')
+    for op in args.operations:
+        if op not in OPERATIONS:
+            parser.error("unknown operation %s" % op)
+
+    services = []
+    for s in args.service or sorted(SERVICES):
+        name, _, command = s.partition('=')
+        if name not in SERVICES:
+            parser.error("unknown service %s" % name)
+        default_command, om_path, hello = SERVICES[name]
+        command = command or default_command
+        if not args.service and not os.path.exists(shlex.split(command)[0]):
+            print("Skipping %s, %s not built" % (name, shlex.split(command)[0]),
+                  file=sys.stderr)
+            continue
+        services.append((name, command, om_path, hello))
+
+    if not services:
+        print("No services to benchmark", file=sys.stderr)
+        return 1
+
+    daemon, address = start_daemon()
+    rows = []
+    try:
+        for name, command, om_path, hello in services:
+            rows.extend(bench_service(name, command, om_path, hello, args,
+                                      address))
+    finally:
+        stop(daemon)
+
+    if args.json:
+        print(json.dumps(dict(metadata=metadata(args), results=rows,
+                              peak=peak_rates(rows)), indent=2))
+    elif args.markdown:
+        print_markdown(rows, args)
+    else:
+        print_tables(rows)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,9 +1,17 @@
-#!/usr/bin/env python2
+#!/usr/bin/env python3
 
+import argparse
+import collections
 import dbus
 import sys
 import pprint
+import shlex
+import signal
+import subprocess
+import time
+import xml.etree.ElementTree as ElementTree
 from dbus.mainloop.glib import DBusGMainLoop
+from gi.repository import GLib
 
 
 # Try and calculate the amount of data a client has available from any
@@ -12,6 +20,29 @@ from dbus.mainloop.glib import DBusGMainLoop
 #
 # Hopefully useful to see how memory savoy a dbus service is, eg. the amount
 # of memory it consumes vs. the amount of data it presents.
+#
+# With --wire we also compute the exact marshalled size of the
+# GetManagedObjects reply message (header and body, including alignment
+# padding, length prefixes, NUL terminators, signatures and variant headers)
+# by re-marshalling it per the D-Bus specification, broken down into payload
+# vs. framing per interface and per property.  Property and interface names
+# used as dictionary keys count as framing.
+#
+# With --survey every name on the bus that exposes an object manager is
+# found (introspecting down from / until an ObjectManager interface shows up)
+# and fetched concurrently with async calls, at most --in-flight outstanding
+# at a time, then summarised in one table.
+#
+# With --crawl the data is gathered the slow way for services without an
+# object manager, Introspect down from the given path and GetAll on every
+# interface with at most --window calls outstanding, and compared against a
+# single GetManagedObjects when the service has one after all.
+#
+# With --memory the service PID is looked up from the bus daemon and its
+# RSS/PSS sampled from /proc/<pid>/smaps_rollup to show bytes of memory per
+# published byte.  --sweep starts the service (--service, eg. the rust or
+# sd-bus demo in this directory which take the object count as their only
+# argument) once per object count and prints the resulting curve.
 
 pp = pprint.PrettyPrinter(indent=4, width=78)
 
@@ -24,41 +55,65 @@ summary = dict(string_num=0, string_size_total=0, booleans=0,
                property_name_num=0, property_name_size_total=0)
 
 
+# Fixed size scalar type -> summary counter
+SCALAR_COUNTERS = {dbus.Boolean: 'booleans', dbus.Byte: 'byte_count',
+                   dbus.UInt64: 'uint64_count', dbus.Int64: 'int64_count',
+                   dbus.UInt32: 'uint32_count', dbus.Int32: 'int32_count',
+                   dbus.Double: 'double_count'}
+
+# String type -> (number counter, size counter)
+STRING_COUNTERS = {
+    dbus.String: ('string_num', 'string_size_total'),
+    dbus.ObjectPath: ('object_path_num', 'object_path_size_total')}
+
+# Homogeneous arrays we can count in bulk, element signature -> counter(s)
+BULK_SCALAR = dict(b='booleans', y='byte_count', t='uint64_count',
+                   x='int64_count', u='uint32_count', i='int32_count',
+                   d='double_count')
+BULK_STRING = dict(s=STRING_COUNTERS[dbus.String],
+                   o=STRING_COUNTERS[dbus.ObjectPath])
+
+
 def size_value(v):
-    if isinstance(v, dbus.String):
-        summary['string_num'] += 1
-        summary['string_size_total'] += len(str(v))
-    elif isinstance(v, dbus.Boolean):
-        summary['booleans'] += 1
-    elif isinstance(v, dbus.ObjectPath):
-        summary['object_path_num'] += 1
-        summary['object_path_size_total'] += len(str(v))
-    elif isinstance(v, dbus.Array):
-        for i in v:
-            size_value(i)
-    elif isinstance(v, dbus.Byte):
-        summary['byte_count'] += 1
-    elif isinstance(v, dbus.UInt64):
-        summary['uint64_count'] += 1
-    elif isinstance(v, dbus.Int64):
-        summary['int64_count'] += 1
-    elif isinstance(v, dbus.UInt32):
-        summary['uint32_count'] += 1
-    elif isinstance(v, dbus.Int32):
-        summary['int32_count'] += 1
-    elif isinstance(v, dbus.Double):
-        summary['double_count'] += 1
-    elif isinstance(v, dbus.Dictionary):
-        for k, ev in v.items():
-            summary['dictionary_key_num'] += 1
-            summary['dictionary_key_size_total'] += len(k)
-            size_value(ev)
-    elif isinstance(v, dbus.Struct):
-        # Treated like a tuple, iterate and sum
-        for i in v:
-            size_value(i)
-    else:
-        print("Unknown %s" % str(type(v)))
+    # Explicit stack instead of recursion and a dispatch on the exact type
+    # instead of an isinstance chain, arrays of basic types are counted
+    # without visiting each element.
+    s = summary
+    stack = [v]
+    while stack:
+        v = stack.pop()
+        t = type(v)
+
+        counter = SCALAR_COUNTERS.get(t)
+        if counter is not None:
+            s[counter] += 1
+            continue
+
+        counters = STRING_COUNTERS.get(t)
+        if counters is not None:
+            s[counters[0]] += 1
+            s[counters[1]] += len(v)
+        elif t is dbus.Array:
+            sig = v.signature
+            if sig in BULK_SCALAR:
+                s[BULK_SCALAR[sig]] += len(v)
+            elif sig in BULK_STRING:
+                counters = BULK_STRING[sig]
+                s[counters[0]] += len(v)
+                s[counters[1]] += sum(map(len, v))
+            else:
+                stack.extend(v)
+        elif t is dbus.Dictionary:
+            s['dictionary_key_num'] += len(v)
+            s['dictionary_key_size_total'] += sum(map(len, v))
+            stack.extend(v.values())
+        elif t is dbus.Struct:
+            # Treated like a tuple, iterate and sum
+            stack.extend(v)
+        elif t is bytes:
+            s['byte_count'] += len(v)
+        else:
+            print("Unknown %s" % str(t))
 
 
 def properties(p):
@@ -69,7 +124,16 @@ def properties(p):
         # print ("Key:%s = Value:%s" % (k, v))
 
 
-def size_summary():
+def reset_summary():
+    for k in summary:
+        summary[k] = 0
+
+
+def size_totals():
+    """
+    Returns (fixed length bytes, variable length bytes) of the data counted
+    in summary
+    """
     total_size_fixed_len = 0
     total_size_fixed_len += summary['booleans']
     total_size_fixed_len += summary['byte_count']
@@ -85,6 +149,11 @@ def size_summary():
     total_size_variable_len += summary['dictionary_key_size_total']
     total_size_variable_len += summary['object_path_size_total']
     total_size_variable_len += summary['property_name_size_total']
+    return total_size_fixed_len, total_size_variable_len
+
+
+def size_summary():
+    total_size_fixed_len, total_size_variable_len = size_totals()
 
     print("We retrieved %d objects" % summary['dbus_object_num'])
     print('Size fixed len data = %d' % total_size_fixed_len)
@@ -95,21 +164,238 @@ def size_summary():
           (float(total)/summary['dbus_object_num']))
 
 
-def retrieve_object_size_data(name_space, object_path):
+# Marshalled size and alignment of the fixed size types
+FIXED_SIZE = dict(y=1, b=4, n=2, q=2, i=4, u=4, h=4, x=8, t=8, d=8)
+ALIGNMENT = dict(FIXED_SIZE, s=4, o=4, g=1, v=1, a=4)
+ALIGNMENT['('] = 8
+ALIGNMENT['{'] = 8
 
-    if sys.argv[1] == 'system':
-        bus = dbus.SystemBus(mainloop=DBusGMainLoop())
-    elif sys.argv[1] == 'session':
-        bus = dbus.SessionBus(mainloop=DBusGMainLoop())
-    else:
-        print("Invalid bus %s" % (sys.argv[1]))
-        sys.exit(1)
+# Checked in order, ObjectPath and Signature are strings too
+TYPE_SIGNATURES = [(dbus.Boolean, 'b'), (dbus.Byte, 'y'), (dbus.Int16, 'n'),
+                   (dbus.UInt16, 'q'), (dbus.Int32, 'i'), (dbus.UInt32, 'u'),
+                   (dbus.Int64, 'x'), (dbus.UInt64, 't'), (dbus.Double, 'd'),
+                   (dbus.ObjectPath, 'o'), (dbus.Signature, 'g'),
+                   (dbus.String, 's'), (bytes, 'ay')]
+
+
+def type_end(sig, i):
+    """
+    Index just past the single complete type starting at sig[i]
+    """
+    c = sig[i]
+    if c == 'a':
+        return type_end(sig, i + 1)
+    if c in '({':
+        close = ')' if c == '(' else '}'
+        i += 1
+        while sig[i] != close:
+            i = type_end(sig, i)
+        return i + 1
+    return i + 1
+
+
+def split_signature(sig):
+    rc = []
+    i = 0
+    while i < len(sig):
+        end = type_end(sig, i)
+        rc.append(sig[i:end])
+        i = end
+    return rc
+
+
+def signature_of(v):
+    for t, s in TYPE_SIGNATURES:
+        if isinstance(v, t):
+            return s
+    if isinstance(v, dbus.Dictionary):
+        if v.signature:
+            return 'a{%s}' % v.signature
+        k, ev = next(iter(v.items()))
+        return 'a{%s%s}' % (signature_of(k), signature_of(ev))
+    if isinstance(v, dbus.Array):
+        if v.signature:
+            return 'a' + v.signature
+        return 'a' + signature_of(v[0])
+    if isinstance(v, dbus.Struct):
+        if v.signature:
+            return '(%s)' % v.signature
+        return '(%s)' % ''.join(signature_of(i) for i in v)
+    raise TypeError("No signature for %s" % str(type(v)))
+
+
+class WireSize(object):
+    """
+    Walks values by signature as libdbus would marshal them, tracking the
+    offset for alignment and attributing every byte to the current bucket as
+    either payload or framing.
+    """
+
+    def __init__(self):
+        self.offset = 0
+        self.bucket = '(message)'
+        self.buckets = dict()
+
+    def add(self, payload, framing):
+        b = self.buckets.setdefault(self.bucket, [0, 0])
+        b[0] += payload
+        b[1] += framing
+        self.offset += payload + framing
+
+    def align(self, n):
+        pad = -self.offset % n
+        if pad:
+            self.add(0, pad)
+
+    def array_start(self, element_sig):
+        # Length prefix, then padding to the first element even when empty
+        self.align(4)
+        self.add(0, 4)
+        self.align(ALIGNMENT[element_sig[0]])
+
+    def value(self, v, sig):
+        c = sig[0]
+        if c in FIXED_SIZE:
+            self.align(FIXED_SIZE[c])
+            self.add(FIXED_SIZE[c], 0)
+        elif c in 'so':
+            self.align(4)
+            self.add(0, 4)
+            self.add(len(v.encode('utf-8')), 1)
+        elif c == 'g':
+            self.add(len(v), 2)
+        elif c == 'v':
+            inner = signature_of(v)
+            self.add(0, len(inner) + 2)
+            self.value(v, inner)
+        elif c == 'a':
+            element = sig[1:]
+            self.array_start(element)
+            if element[0] == '{':
+                key_sig, value_sig = split_signature(element[1:-1])
+                for k, ev in v.items():
+                    self.align(8)
+                    self.value(k, key_sig)
+                    self.value(ev, value_sig)
+            else:
+                for i in v:
+                    self.value(i, element)
+        elif c == '(':
+            self.align(8)
+            for i, t in zip(v, split_signature(sig[1:-1])):
+                self.value(i, t)
+        else:
+            raise TypeError("Unsupported signature %s" % sig)
+
+
+def wire_size(objects, destination, sender):
+    """
+    Exact size of the method return carrying objects as the GetManagedObjects
+    reply body (signature a{oa{sa{sv}}}).
+    """
+    w = WireSize()
+
+    # Fixed header: endian, type, flags, version, body length, serial
+    w.add(0, 12)
+    header_fields = [(5, dbus.UInt32(1)),
+                     (6, dbus.String(destination)),
+                     (7, dbus.String(sender)),
+                     (8, dbus.Signature('a{oa{sa{sv}}}'))]
+    w.array_start('(')
+    for code, v in header_fields:
+        w.align(8)
+        w.add(0, 1)
+        w.value(v, 'v')
+    w.align(8)
+
+    # None of the header is payload
+    header = w.buckets['(message)']
+    header[1] += header[0]
+    header[0] = 0
+
+    w.bucket = '(objects)'
+    w.array_start('{')
+    for object_path, interfaces in objects.items():
+        w.bucket = '(objects)'
+        w.align(8)
+        w.value(object_path, 'o')
+        w.array_start('{')
+        for interface, props in interfaces.items():
+            w.bucket = (interface, None)
+            w.align(8)
+            w.value(interface, 's')
+            w.array_start('{')
+            for prop, v in props.items():
+                w.bucket = (interface, prop)
+                w.align(8)
+                w.value(prop, 's')
+                w.value(v, 'v')
+
+    return w
+
+
+def wire_summary(w):
+    interfaces = dict()
+    properties = []
+    other = []
+    for key, (payload, framing) in w.buckets.items():
+        if isinstance(key, tuple):
+            i = interfaces.setdefault(key[0], [0, 0])
+            i[0] += payload
+            i[1] += framing
+            if key[1] is not None:
+                properties.append(("%s.%s" % key, payload, framing))
+        else:
+            other.append((key, payload, framing))
+
+    def row(name, payload, framing):
+        total = payload + framing
+        print("%-60s %10d %10d %10d %5.1f%%" %
+              (name, payload, framing, total,
+               100.0 * framing / total if total else 0.0))
+
+    header = ("%-60s %10s %10s %10s %6s" %
+              ("", "payload", "framing", "total", "frame"))
+
+    print("\nMarshalled GetManagedObjects reply = %d bytes" % w.offset)
+    print(header)
+    for name, payload, framing in sorted(other):
+        row(name, payload, framing)
+
+    print("\nPer interface")
+    print(header)
+    for name, (payload, framing) in sorted(interfaces.items(),
+                                           key=lambda x: -sum(x[1])):
+        row(name, payload, framing)
+
+    print("\nPer property")
+    print(header)
+    for name, payload, framing in sorted(properties,
+                                         key=lambda x: -(x[1] + x[2])):
+        row(name, payload, framing)
+
+
+def get_bus(bus_type):
+    if bus_type == 'system':
+        return dbus.SystemBus(mainloop=DBusGMainLoop())
+    elif bus_type == 'session':
+        return dbus.SessionBus(mainloop=DBusGMainLoop())
+
+    print("Invalid bus %s" % bus_type)
+    sys.exit(1)
+
+
+def retrieve_object_size_data(bus, name_space, object_path):
 
     manager = dbus.Interface(bus.get_object(name_space, object_path),
                              "org.freedesktop.DBus.ObjectManager")
 
     objects = manager.GetManagedObjects(timeout=1000)
+    size_objects(objects)
+    return objects
 
+
+def size_objects(objects):
     for object_path, val in objects.items():
         summary['dbus_object_num'] += 1
         summary['object_path_num'] += 1
@@ -120,15 +406,440 @@ def retrieve_object_size_data(name_space, object_path):
             properties(props)
 
 
+def service_pid(bus, name):
+    daemon = dbus.Interface(bus.get_object('org.freedesktop.DBus',
+                                           '/org/freedesktop/DBus'),
+                            'org.freedesktop.DBus')
+    return int(daemon.GetConnectionUnixProcessID(name))
+
+
+def process_memory(pid):
+    """
+    Returns dict(rss=, pss=) in bytes, pss is None when smaps_rollup isn't
+    available (older kernels) and we fall back to VmRSS from status
+    """
+    rc = dict(rss=None, pss=None)
+    try:
+        with open('/proc/%d/smaps_rollup' % pid) as f:
+            for line in f:
+                k, _, v = line.partition(':')
+                if k in ('Rss', 'Pss'):
+                    rc[k.lower()] = int(v.split()[0]) * 1024
+        return rc
+    except (IOError, OSError):
+        pass
+
+    with open('/proc/%d/status' % pid) as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                rc['rss'] = int(line.split()[1]) * 1024
+    return rc
+
+
+def memory_summary(mem, published):
+    def ratio(v):
+        return "%.2f" % (float(v) / published) if v and published else "n/a"
+
+    print("\nService RSS %s bytes, PSS %s bytes" %
+          (mem['rss'], mem['pss'] if mem['pss'] is not None else "n/a"))
+    print("Memory bytes per published byte: RSS %s, PSS %s" %
+          (ratio(mem['rss']), ratio(mem['pss'])))
+
+
+def wait_for_name(bus, name, proc, timeout):
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        if proc.poll() is not None:
+            raise RuntimeError("service exited with %d" % proc.returncode)
+        if bus.name_has_owner(name):
+            return
+        time.sleep(0.05)
+    raise RuntimeError("%s never showed up on the bus" % name)
+
+
+def sweep(bus, name, object_path, service, counts, timeout):
+    """
+    Start service once for each object count, wait for it to own name, fetch
+    everything and sample its memory.  Returns a list of
+    (requested count, objects, published bytes, rss, pss)
+    """
+    rc = []
+    for count in counts:
+        proc = subprocess.Popen(shlex.split(service.format(count=count)))
+        try:
+            wait_for_name(bus, name, proc, timeout)
+            reset_summary()
+            retrieve_object_size_data(bus, name, object_path)
+            published = sum(size_totals())
+            mem = process_memory(service_pid(bus, name))
+            rc.append((count, summary['dbus_object_num'], published,
+                       mem['rss'], mem['pss']))
+        finally:
+            proc.send_signal(signal.SIGTERM)
+            proc.wait()
+
+        # Let the bus notice the name going away before the next start
+        end = time.monotonic() + timeout
+        while bus.name_has_owner(name) and time.monotonic() < end:
+            time.sleep(0.05)
+    return rc
+
+
+def _na(v):
+    return v if v is not None else "n/a"
+
+
+def _per_byte(v, published):
+    if v is None or not published:
+        return "n/a"
+    return "%.2f" % (float(v) / published)
+
+
+def sweep_summary(results):
+    print("%10s %10s %14s %14s %14s %9s %9s %12s" %
+          ("requested", "objects", "published", "rss", "pss", "rss/byte",
+           "pss/byte", "marginal"))
+    prev = None
+    for count, objects, published, rss, pss in results:
+        marginal = "n/a"
+        # Slope between points, the memory cost of each added published byte,
+        # PSS when both points have it, never mixing PSS with RSS
+        if prev is not None and published != prev[0]:
+            if pss is not None and prev[2] is not None:
+                mem, prev_mem = pss, prev[2]
+            else:
+                mem, prev_mem = rss, prev[1]
+            if mem is not None and prev_mem is not None:
+                marginal = "%.2f" % (float(mem - prev_mem) /
+                                     (published - prev[0]))
+        prev = (published, rss, pss)
+        print("%10d %10d %14d %14s %14s %9s %9s %12s" %
+              (count, objects, published, _na(rss), _na(pss),
+               _per_byte(rss, published), _per_byte(pss, published),
+               marginal))
+
+
+OBJECT_MANAGER = "org.freedesktop.DBus.ObjectManager"
+INTROSPECTABLE = "org.freedesktop.DBus.Introspectable"
+PROPERTIES = "org.freedesktop.DBus.Properties"
+
+# How far below / we look for an object manager before giving up on a name
+SURVEY_MAX_DEPTH = 6
+
+
+class CallQueue(object):
+    """
+    All calls are async and go through one queue so no more than
+    max_in_flight are outstanding, run() returns when it's drained.
+    """
+
+    def __init__(self, bus, max_in_flight, timeout):
+        self.bus = bus
+        self.max_in_flight = max_in_flight
+        self.timeout = timeout
+        self.queue = collections.deque()
+        self.in_flight = 0
+        self.errors = []
+        self.loop = GLib.MainLoop()
+
+    def _call(self, name, path, interface, method, reply, error,
+              signature='', args=()):
+        self.queue.append((name, path, interface, method, signature, args,
+                           reply, error))
+
+    def _pump(self):
+        while self.queue and self.in_flight < self.max_in_flight:
+            name, path, interface, method, signature, args, reply, error = \
+                self.queue.popleft()
+            start = time.monotonic()
+
+            def _reply(result, reply=reply, start=start):
+                self._done()
+                reply(result, time.monotonic() - start)
+
+            def _error(e, error=error):
+                self._done()
+                error(e)
+
+            self.in_flight += 1
+            self.bus.call_async(name, path, interface, method, signature,
+                                args, _reply, _error, timeout=self.timeout)
+
+        if not self.in_flight and not self.queue:
+            self.loop.quit()
+
+    def _done(self):
+        self.in_flight -= 1
+        # Let the caller queue follow up work before we refill
+        GLib.idle_add(self._idle_pump)
+
+    def _idle_pump(self):
+        self._pump()
+        return False
+
+    def _error(self, name, path, e):
+        self.errors.append((name, path, str(e)))
+
+    def _run(self):
+        GLib.idle_add(self._idle_pump)
+        self.loop.run()
+
+
+class Survey(CallQueue):
+    """
+    Finds and sizes every object manager on the bus.
+    """
+
+    def __init__(self, bus, max_in_flight, timeout):
+        super(Survey, self).__init__(bus, max_in_flight, timeout)
+        self.results = []
+
+    def _introspect(self, name, path):
+        def _reply(xml, latency):
+            try:
+                node = ElementTree.fromstring(xml)
+            except ElementTree.ParseError as e:
+                self.errors.append((name, path, str(e)))
+                return
+
+            if any(i.get('name') == OBJECT_MANAGER
+                   for i in node.findall('interface')):
+                self._call(name, path, OBJECT_MANAGER, 'GetManagedObjects',
+                           lambda objects, latency:
+                           self._objects(name, path, objects, latency),
+                           lambda e: self._error(name, path, e))
+            elif path.count('/') < SURVEY_MAX_DEPTH:
+                for child in node.findall('node'):
+                    c = child.get('name')
+                    if c:
+                        self._introspect(
+                            name, path.rstrip('/') + '/' + c)
+
+        self._call(name, path, INTROSPECTABLE, 'Introspect',
+                   _reply, lambda e: self._error(name, path, e))
+
+    def _objects(self, name, path, objects, latency):
+        reset_summary()
+        size_objects(objects)
+        total = sum(size_totals())
+        self.results.append((name, path, summary['dbus_object_num'], total,
+                             latency))
+
+    def run(self):
+        names = self.bus.list_names()
+        for name in sorted(n for n in names
+                           if not n.startswith(':') and
+                           n != 'org.freedesktop.DBus'):
+            self._introspect(name, '/')
+
+        self._run()
+        return self.results, self.errors
+
+
+# Interfaces every object has, not part of what GetManagedObjects returns
+STANDARD_INTERFACES = ("org.freedesktop.DBus.Introspectable",
+                       "org.freedesktop.DBus.Properties",
+                       "org.freedesktop.DBus.Peer",
+                       OBJECT_MANAGER)
+
+
+class Crawl(CallQueue):
+    """
+    Builds what GetManagedObjects would have returned for a service that
+    doesn't implement it, walking the tree with Introspect and fetching each
+    interface with Properties.GetAll, keeping up to window calls in flight.
+    """
+
+    def __init__(self, bus, name, root, window, timeout):
+        super(Crawl, self).__init__(bus, window, timeout)
+        self.name = name
+        self.root = root
+        self.objects = dict()
+        self.introspect_calls = 0
+        self.get_all_calls = 0
+        self.object_managers = []
+
+    def _introspect(self, path):
+        def _reply(xml, latency):
+            try:
+                node = ElementTree.fromstring(xml)
+            except ElementTree.ParseError as e:
+                self._error(self.name, path, e)
+                return
+
+            for i in node.findall('interface'):
+                interface = i.get('name')
+                if interface == OBJECT_MANAGER:
+                    self.object_managers.append(path)
+                if interface in STANDARD_INTERFACES:
+                    continue
+
+                interfaces = self.objects.setdefault(dbus.ObjectPath(path),
+                                                     dict())
+                if i.find('property') is None:
+                    interfaces[dbus.String(interface)] = dbus.Dictionary(
+                        signature='sv')
+                else:
+                    self._get_all(path, interface)
+
+            for child in node.findall('node'):
+                c = child.get('name')
+                if c:
+                    self._introspect(path.rstrip('/') + '/' + c)
+
+        self.introspect_calls += 1
+        self._call(self.name, path, INTROSPECTABLE, 'Introspect', _reply,
+                   lambda e: self._error(self.name, path, e))
+
+    def _get_all(self, path, interface):
+        def _reply(props, latency):
+            self.objects[dbus.ObjectPath(path)][dbus.String(interface)] = \
+                props
+
+        self.get_all_calls += 1
+        self._call(self.name, path, PROPERTIES, 'GetAll', _reply,
+                   lambda e: self._error(self.name, path, e),
+                   's', (interface,))
+
+    def run(self):
+        """
+        Returns (objects, seconds the crawl took)
+        """
+        start = time.monotonic()
+        self._introspect(self.root)
+        self._run()
+        return self.objects, time.monotonic() - start
+
+
+def time_get_managed_objects(bus, name, object_path):
+    manager = dbus.Interface(bus.get_object(name, object_path),
+                             OBJECT_MANAGER)
+    start = time.monotonic()
+    objects = manager.GetManagedObjects(timeout=1000)
+    return objects, time.monotonic() - start
+
+
+def crawl_summary(crawl, objects, elapsed, managed):
+    """
+    managed is (object manager path, objects, seconds) or None
+    """
+    print("\nCrawled %d objects in %.3f seconds with %d Introspect and %d "
+          "GetAll calls, window %d" %
+          (len(objects), elapsed, crawl.introspect_calls,
+           crawl.get_all_calls, crawl.max_in_flight))
+    for name, path, msg in sorted(crawl.errors):
+        print("Error %s %s: %s" % (name, path, msg))
+
+    if managed is None:
+        print("No ObjectManager found, nothing to compare against")
+        return
+
+    path, managed_objects, managed_elapsed = managed
+    print("GetManagedObjects on %s returned %d objects in %.3f seconds" %
+          (path, len(managed_objects), managed_elapsed))
+    if managed_elapsed:
+        print("Crawl is %.1fx slower than a single GetManagedObjects" %
+              (elapsed / managed_elapsed))
+
+
+def survey_summary(results, errors):
+    print("%-40s %-40s %8s %12s %10s %10s" %
+          ("name", "object manager", "objects", "bytes", "bytes/obj",
+           "fetch ms"))
+    for name, path, objects, total, latency in \
+            sorted(results, key=lambda x: -x[3]):
+        print("%-40s %-40s %8d %12d %10d %10.1f" %
+              (name, path, objects, total,
+               total / objects if objects else 0, latency * 1000.0))
+
+    if errors:
+        print("\nErrors")
+        for name, path, msg in sorted(errors):
+            print("%s %s: %s" % (name, path, msg))
+
+
 if __name__ == '__main__':
-    if len(sys.argv) != 4:
-        print("syntax: [system|session] <bus name> <object path>")
-        print("\nexample \n"
-              "./dbus_size.py session com.blah.storage /com/blah/storage/block")
-        sys.exit(1)
+    parser = argparse.ArgumentParser(
+        description="Size the data a dbus object manager presents",
+        epilog="example: ./dbus_size.py session com.blah.storage "
+               "/com/blah/storage/block")
+    parser.add_argument("bus", choices=['system', 'session'])
+    parser.add_argument("name", nargs='?', help="bus name")
+    parser.add_argument("path", nargs='?', help="object manager path")
+    parser.add_argument("--wire", action="store_true",
+                        help="exact marshalled size of the reply")
+    parser.add_argument("--survey", action="store_true",
+                        help="size every object manager on the bus")
+    parser.add_argument("--in-flight", type=int, default=8,
+                        help="max outstanding calls for --survey "
+                             "(default: %(default)s)")
+    parser.add_argument("--timeout", type=float, default=60.0,
+                        help="per call timeout in seconds for --survey, "
+                             "service start timeout for --sweep "
+                             "(default: %(default)s)")
+    parser.add_argument("--crawl", action="store_true",
+                        help="walk the tree below path with Introspect and "
+                             "GetAll instead of using GetManagedObjects")
+    parser.add_argument("--window", type=int, default=16,
+                        help="max outstanding calls for --crawl "
+                             "(default: %(default)s)")
+    parser.add_argument("--memory", action="store_true",
+                        help="sample service RSS/PSS and compare with the "
+                             "published data")
+    parser.add_argument("--sweep", metavar="COUNTS",
+                        help="comma separated object counts to start "
+                             "--service with, eg. 100,1000,10000")
+    parser.add_argument("--service", metavar="COMMAND",
+                        help="service command line for --sweep, {count} is "
+                             "replaced with the object count, eg. "
+                             "'./sd-bus/sd_simple {count}'")
+    args = parser.parse_args()
+
+    the_bus = get_bus(args.bus)
 
-    retrieve_object_size_data(sys.argv[2], sys.argv[3])
+    if args.survey:
+        survey_summary(*Survey(the_bus, max(1, args.in_flight),
+                               args.timeout).run())
+        sys.exit(0)
+
+    if args.name is None or args.path is None:
+        parser.error("bus name and object path are required")
+
+    if args.sweep:
+        if not args.service:
+            parser.error("--sweep needs --service")
+        try:
+            sweep_counts = [int(c) for c in args.sweep.split(',')]
+        except ValueError:
+            parser.error("invalid --sweep %s" % args.sweep)
+        sweep_summary(sweep(the_bus, args.name, args.path, args.service,
+                            sweep_counts, args.timeout))
+        sys.exit(0)
+
+    if args.crawl:
+        crawl = Crawl(the_bus, args.name, args.path, max(1, args.window),
+                      args.timeout)
+        result, crawl_elapsed = crawl.run()
+        size_objects(result)
+    else:
+        result = retrieve_object_size_data(the_bus, args.name, args.path)
 
     pp.pprint(summary)
     size_summary()
+
+    if args.crawl:
+        managed_result = None
+        if crawl.object_managers:
+            om_path = crawl.object_managers[0]
+            managed_result = (om_path,) + time_get_managed_objects(
+                the_bus, args.name, om_path)
+        crawl_summary(crawl, result, crawl_elapsed, managed_result)
+
+    if args.wire:
+        wire_summary(wire_size(result, the_bus.get_unique_name(),
+                               the_bus.get_name_owner(args.name)))
+
+    if args.memory:
+        memory_summary(process_memory(service_pid(the_bus, args.name)),
+                       sum(size_totals()))
     sys.exit(0)
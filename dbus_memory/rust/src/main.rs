@@ -19,6 +19,12 @@ impl DataType for OPData {
 }
 
 fn main() {
+    // Optional number of objects to publish, used by dbus_size.py --sweep
+    let count: u32 = std::env::args()
+        .nth(1)
+        .map(|a| a.parse().unwrap())
+        .unwrap_or(9999);
+
     let c = Connection::get_private(BusType::Session).unwrap();
     c.register_name("com.blah.storage", NameFlag::ReplaceExisting as u32)
         .unwrap();
@@ -85,7 +91,7 @@ fn main() {
     }
     let interface = Arc::new(interface);
 
-    for i in 0..9999 {
+    for i in 0..count {
         let object_name = format!("/com/blah/storage/block/{}", i);
         let v_name = format!("lvol{}", i);
 
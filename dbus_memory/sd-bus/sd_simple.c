@@ -123,10 +123,16 @@ struct object * make_block(int num) {
     return NULL;
 }
 
-int main() {
+int main(int argc, char **argv) {
     sd_bus *bus = NULL;
     int r = 0;
     int i = 0;
+    int count = 10000;
+
+    // Optional number of objects to publish, used by dbus_size.py --sweep
+    if (argc > 1) {
+        count = atoi(argv[1]);
+    }
 
     r = sd_bus_open_system(&bus);
 
@@ -149,7 +155,7 @@ int main() {
         goto out;
     }
 
-    for (i = 0; i < 10000; ++i ) {
+    for (i = 0; i < count; ++i ) {
         char object_path[128];
 
         snprintf(object_path, sizeof(object_path), "/com/blah/storage/block/%d", i);
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+import sys
+import time
+
+import dbus
+
+import dbus_size
+
+# Micro-benchmark of the dbus_size.py value walker against the original
+# recursive isinstance chain on a synthetic GetManagedObjects reply.
+#
+# ./size_bench.py [number of objects, default 100000]
+
+
+def size_value_recursive(v):
+    summary = dbus_size.summary
+    if isinstance(v, dbus.String):
+        summary['string_num'] += 1
+        summary['string_size_total'] += len(v)
+    elif isinstance(v, dbus.Boolean):
+        summary['booleans'] += 1
+    elif isinstance(v, dbus.ObjectPath):
+        summary['object_path_num'] += 1
+        summary['object_path_size_total'] += len(v)
+    elif isinstance(v, dbus.Array):
+        for i in v:
+            size_value_recursive(i)
+    elif isinstance(v, dbus.Byte):
+        summary['byte_count'] += 1
+    elif isinstance(v, dbus.UInt64):
+        summary['uint64_count'] += 1
+    elif isinstance(v, dbus.Int64):
+        summary['int64_count'] += 1
+    elif isinstance(v, dbus.UInt32):
+        summary['uint32_count'] += 1
+    elif isinstance(v, dbus.Int32):
+        summary['int32_count'] += 1
+    elif isinstance(v, dbus.Double):
+        summary['double_count'] += 1
+    elif isinstance(v, dbus.Dictionary):
+        for k, ev in v.items():
+            summary['dictionary_key_num'] += 1
+            summary['dictionary_key_size_total'] += len(k)
+            size_value_recursive(ev)
+    elif isinstance(v, dbus.Struct):
+        for i in v:
+            size_value_recursive(i)
+
+
+def synthetic_reply(count):
+    blob = dbus.Array([dbus.Byte(i % 256) for i in range(512)],
+                      signature='y')
+    rc = dict()
+    for i in range(count):
+        props = dbus.Dictionary({
+            dbus.String('Name'): dbus.String('block_%d' % i),
+            dbus.String('Uuid'): dbus.String(
+                'kQ1BLF-iBTn-FiHR-x8yI-DEqt-%010d' % i),
+            dbus.String('Size'): dbus.UInt64(i * 4096),
+            dbus.String('ReadOnly'): dbus.Boolean(False),
+            dbus.String('Symlinks'): dbus.Array(
+                [dbus.String('/dev/disk/by-id/%d-%d' % (i, j))
+                 for j in range(4)], signature='s'),
+            dbus.String('Extents'): dbus.Array(
+                [dbus.UInt64(j) for j in range(16)], signature='t'),
+            dbus.String('Label'): blob,
+            dbus.String('Holders'): dbus.Array(
+                [dbus.Struct((dbus.ObjectPath('/com/blah/storage/block/%d' % i),
+                              dbus.Int32(j)), signature='oi')
+                 for j in range(2)], signature='(oi)'),
+        }, signature='sv')
+        rc[dbus.ObjectPath('/com/blah/storage/block/%d' % i)] = \
+            dbus.Dictionary({dbus.String('com.blah.storage.BlockDevice'):
+                             props}, signature='sa{sv}')
+    return rc
+
+
+def run(walker, reply):
+    for k in dbus_size.summary:
+        dbus_size.summary[k] = 0
+
+    start = time.time()
+    for interfaces in reply.values():
+        for props in interfaces.values():
+            for v in props.values():
+                walker(v)
+    return time.time() - start, dict(dbus_size.summary)
+
+
+if __name__ == '__main__':
+    num = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+    print("Building %d synthetic objects" % num)
+    objects = synthetic_reply(num)
+
+    old_time, old_summary = run(size_value_recursive, objects)
+    new_time, new_summary = run(dbus_size.size_value, objects)
+
+    if old_summary != new_summary:
+        print("Summaries differ!\nrecursive: %s\ndispatch : %s" %
+              (old_summary, new_summary))
+        sys.exit(1)
+
+    print("recursive isinstance walker : %f seconds" % old_time)
+    print("dispatch table walker       : %f seconds" % new_time)
+    print("speedup                     : %.1fx" % (old_time / new_time))
+    sys.exit(0)
@@ -136,6 +136,39 @@ fn main() {
 
     interface = interface.add_m(all_the_things_method_deprecated);
 
+    // Echo methods for container and large payload throughput, whatever comes
+    // in goes back out unchanged.
+    fn echo(m: &MethodInfo<MTFn<OPData>, OPData>) -> MethodResult {
+        let items = m.msg.get_items();
+        let mut return_message = m.msg.method_return();
+        return_message.append_items(&items);
+        Ok(vec![return_message])
+    }
+
+    // Byte arrays as a slice, one MessageItem per byte doesn't scale to MiBs
+    fn echo_bytes(m: &MethodInfo<MTFn<OPData>, OPData>) -> MethodResult {
+        let data: &[u8] = m.msg.read1()?;
+        Ok(vec![m.msg.method_return().append1(data)])
+    }
+
+    interface = interface.add_m(
+        f.method("EchoBytes", (), echo_bytes)
+            .in_arg(("data", "ay"))
+            .out_arg(("data", "ay")),
+    );
+
+    for (name, sig) in &[
+        ("EchoDict", "a{sv}"),
+        ("EchoStructs", "a(sst)"),
+        ("EchoVariant", "v"),
+    ] {
+        interface = interface.add_m(
+            f.method(*name, (), echo)
+                .in_arg(("data", *sig))
+                .out_arg(("data", *sig)),
+        );
+    }
+
     interface = interface.add_p(f.property::<&str, _>("some_string", ()).on_get(|i, _| {
         i.append("ABCDEFGHIJKLMNOPQRSTUVWXYZ_0123456789");
         Ok(())
@@ -1,11 +1,30 @@
 #!/usr/bin/env python3
 
+import argparse
 import dbus
+import itertools
+import math
+import multiprocessing
+import struct
 import sys
+import time
 from dbus.mainloop.glib import DBusGMainLoop
+from gi.repository import GLib
 
 # Validate data values.
 #
+# The in/out checks cover every pair of argument values (--strength for
+# t-wise, --exhaustive for every combination) and are pipelined, up to
+# --window calls are outstanding and replies are checked as they arrive, so
+# the run also reports calls/s and latency percentiles for both methods.
+# With --workers the argument matrix is split round robin over worker
+# processes, each with its own connection, and a failing shard can be re-run
+# alone with --shard.
+#
+# --payload instead echoes a{sv}, a(sst), ay and nested variants of growing
+# size through the Echo* methods, checking each reply and reporting latency
+# and MB/s of data (strings and fixed size values, not framing) by size.
+#
 # Hardcoded property values in service based on property name
 EXPECTED_VAL = {
     "some_string": "ABCDEFGHIJKLMNOPQRSTUVWXYZ_0123456789",
@@ -32,60 +51,382 @@ def properties(p):
             print("Missing type, Key:%s = Value:%s" % (str(k), str(v)))
 
 
-def check_in_out(proxy):
-    for a0 in [0, 128, 255]:
-        for a1 in [True, False]:
-            for a2 in [-32768, -1, 1, 32767]:
-                for a3 in [0, 2**15, 2**16-1]:
-                    for a4 in [-2147483648, -1, 1, 2147483647]:
-                        for a5 in [0, 0x11223344, 2**32-1]:
-                            for a6 in [-9223372036854775808, -1, 0,
-                                       9223372036854775807]:
-                                for a7 in [0, 0x1122334455667788, 2**64-1]:
-                                    for a8 in [-1.7976931348623157e+308,
-                                               -1.1, 0.0,
-                                               2.2250738585072014e-308,
-                                               1.7976931348623157e+308]:
-                                        result_new_arg = proxy.AllTheThings(
-                                            dbus.Byte(a0),
-                                            dbus.Boolean(a1),
-                                            dbus.Int16(a2),
-                                            dbus.UInt16(a3),
-                                            dbus.Int32(a4),
-                                            dbus.UInt32(a5),
-                                            dbus.Int64(a6),
-                                            dbus.UInt64(a7),
-                                            dbus.Double(a8))
-
-                                        result_deprecated = proxy.\
-                                            AllTheThingsDeprecated(
-                                            dbus.Byte(a0),
-                                            dbus.Boolean(a1),
-                                            dbus.Int16(a2),
-                                            dbus.UInt16(a3),
-                                            dbus.Int32(a4),
-                                            dbus.UInt32(a5),
-                                            dbus.Int64(a6),
-                                            dbus.UInt64(a7),
-                                            dbus.Double(a8))
-
-                                        expected = (a0, a1, a2, a3, a4,
-                                                    a5, a6, a7, a8)
-
-                                        if expected != result_new_arg:
-                                            print("Expected  : ", expected)
-                                            print("Actual new: ",
-                                                  result_new_arg)
-
-                                        assert expected == result_new_arg
-
-                                        if expected != result_deprecated:
-                                            print("Expected  :", expected)
-                                            print("Actual Dep:",
-                                                  result_deprecated)
-
-
-def check_values(name_space, object_path):
+# Argument values exercised by check_in_out, a pairwise (or --strength t-wise)
+# covering array of them is sent, every combination only with --exhaustive
+ARG_VALUES = [
+    (dbus.Byte, [0, 128, 255]),
+    (dbus.Boolean, [True, False]),
+    (dbus.Int16, [-32768, -1, 1, 32767]),
+    (dbus.UInt16, [0, 2**15, 2**16-1]),
+    (dbus.Int32, [-2147483648, -1, 1, 2147483647]),
+    (dbus.UInt32, [0, 0x11223344, 2**32-1]),
+    (dbus.Int64, [-9223372036854775808, -1, 0, 9223372036854775807]),
+    (dbus.UInt64, [0, 0x1122334455667788, 2**64-1]),
+    (dbus.Double, [-1.7976931348623157e+308, -1.1, 0.0, -0.0,
+                   2.2250738585072014e-308, 2.2250738585072009e-308,
+                   5e-324, 1.7976931348623157e+308, float('nan')])]
+
+ARG_SIGNATURE = 'ybnqiuxtd'
+
+METHODS = ["AllTheThings", "AllTheThingsDeprecated"]
+
+
+def covering_array(value_lists, t):
+    """
+    Rows such that every t values from t different lists appear together in
+    at least one row.  Greedy and deterministic: seed each row with the
+    smallest uncovered t-tuple, then fill the other columns in order with
+    the value covering the most uncovered tuples.
+    """
+    n = len(value_lists)
+    if t >= n:
+        return list(itertools.product(*value_lists))
+
+    # Work with value indexes, NaN doesn't behave in sets
+    column_sets = list(itertools.combinations(range(n), t))
+    uncovered = set()
+    for cols in column_sets:
+        for vals in itertools.product(*[range(len(value_lists[c]))
+                                        for c in cols]):
+            uncovered.add((cols, vals))
+    touching = [[cols for cols in column_sets if c in cols]
+                for c in range(n)]
+
+    rows = []
+    while uncovered:
+        row = [None] * n
+        cols, vals = min(uncovered)
+        for c, v in zip(cols, vals):
+            row[c] = v
+
+        for c in range(n):
+            if row[c] is not None:
+                continue
+            best, best_count = 0, -1
+            for v in range(len(value_lists[c])):
+                row[c] = v
+                count = sum(1 for cols in touching[c]
+                            if all(row[i] is not None for i in cols) and
+                            (cols, tuple(row[i] for i in cols)) in uncovered)
+                if count > best_count:
+                    best, best_count = v, count
+            row[c] = best
+
+        uncovered.difference_update(
+            (cols, tuple(row[i] for i in cols)) for cols in column_sets)
+        rows.append(tuple(value_lists[c][row[c]] for c in range(n)))
+    return rows
+
+
+def argument_matrix(strength=None):
+    """
+    Every combination of ARG_VALUES, or with strength a t-wise covering array
+    """
+    value_lists = [values for _, values in ARG_VALUES]
+    if strength is None:
+        return itertools.product(*value_lists)
+    return iter(covering_array(value_lists, strength))
+
+
+def same_value(a, b):
+    # Bitwise for doubles, NaN == NaN and -0.0 != 0.0
+    if isinstance(a, float):
+        return struct.pack('<d', a) == struct.pack('<d', float(b))
+    return a == b
+
+
+def same_values(expected, actual):
+    return len(expected) == len(actual) and \
+        all(same_value(a, b) for a, b in zip(expected, actual))
+
+
+def shard(combinations, index, count):
+    """
+    Combinations for shard index of count as (combination number, values),
+    assigned round robin so the same shard always gets the same ones
+    """
+    return ((i, c) for i, c in enumerate(combinations)
+            if i % count == index)
+
+
+def percentile(ordered, p):
+    # Nearest rank
+    if not ordered:
+        return 0.0
+    k = int(math.ceil(p / 100.0 * len(ordered))) - 1
+    return ordered[max(0, min(len(ordered) - 1, k))]
+
+
+class Pipeline(object):
+    """
+    Sends every argument combination to both methods with async calls,
+    keeping at most window outstanding, and checks each reply as it arrives.
+    """
+
+    def __init__(self, bus, object_path, interface, window):
+        self.bus = bus
+        self.object_path = object_path
+        self.interface = interface
+        self.window = window
+        self.calls = None
+        self.in_flight = 0
+        self.latencies = dict((m, []) for m in METHODS)
+        # (combination number, method, expected, actual) for AllTheThings,
+        # which must round trip
+        self.failures = []
+        # Only reported for the deprecated method
+        self.mismatches = []
+        self.errors = []
+        self.loop = GLib.MainLoop()
+
+    def _issue(self):
+        try:
+            method, number, expected = next(self.calls)
+        except StopIteration:
+            if not self.in_flight:
+                self.loop.quit()
+            return
+
+        args = [t(v) for (t, _), v in zip(ARG_VALUES, expected)]
+        start = time.monotonic()
+        self.in_flight += 1
+        self.bus.call_async(
+            "com.blah.sizecheck", self.object_path, self.interface, method,
+            ARG_SIGNATURE, args,
+            lambda *result: self._reply(method, number, expected, start,
+                                        result),
+            lambda e: self._error(method, number, expected, e))
+
+    def _reply(self, method, number, expected, start, result):
+        self.latencies[method].append(time.monotonic() - start)
+        self.in_flight -= 1
+
+        if not same_values(expected, result):
+            if method == "AllTheThings":
+                print("Expected  : ", expected)
+                print("Actual new: ", result)
+                self.failures.append((number, method, expected,
+                                      tuple(result)))
+            else:
+                print("Expected  :", expected)
+                print("Actual Dep:", result)
+                self.mismatches.append((number, method, expected,
+                                        tuple(result)))
+        self._issue()
+
+    def _error(self, method, number, expected, e):
+        print("Error %s%s: %s" % (method, str(expected), str(e)))
+        self.errors.append((number, method, expected, str(e)))
+        self.in_flight -= 1
+        self._issue()
+
+    def run(self, combinations):
+        """
+        Sends (combination number, values) from combinations, returns a
+        results dict that can cross a process boundary
+        """
+        self.calls = ((m, n, c) for n, c in combinations for m in METHODS)
+        start = time.monotonic()
+        for _ in range(self.window):
+            self._issue()
+        if self.in_flight:
+            self.loop.run()
+        return dict(elapsed=time.monotonic() - start, window=self.window,
+                    latencies=self.latencies, failures=self.failures,
+                    mismatches=self.mismatches, errors=self.errors)
+
+
+def run_shard(object_path, interface, window, index, count, strength):
+    # Runs in a worker process, so its own connection
+    bus = dbus.SessionBus(mainloop=DBusGMainLoop())
+    r = Pipeline(bus, object_path, interface, window).run(
+        shard(argument_matrix(strength), index, count))
+    r['shard'] = index
+    return r
+
+
+def merge_results(results, elapsed):
+    """
+    Combine the per shard results, elapsed is the wall clock of the whole run
+    """
+    rc = dict(elapsed=elapsed, window=results[0]['window'],
+              latencies=dict((m, []) for m in METHODS), failures=[],
+              mismatches=[], errors=[], shards=[])
+    for r in sorted(results, key=lambda x: x.get('shard', 0)):
+        for m in METHODS:
+            rc['latencies'][m].extend(r['latencies'][m])
+        for k in ('failures', 'mismatches', 'errors'):
+            rc[k].extend(r[k])
+        rc['shards'].append((r.get('shard', 0), r['elapsed'],
+                             sum(len(v) for v in r['latencies'].values())))
+    return rc
+
+
+def pipeline_summary(r, shards=1):
+    total = sum(len(v) for v in r['latencies'].values())
+    elapsed = r['elapsed']
+    print("%d calls in %.2f seconds, %.0f calls/s, window %d, %d shard(s)" %
+          (total, elapsed, total / elapsed if elapsed else 0.0, r['window'],
+           shards))
+    for index, shard_elapsed, calls in r.get('shards', []):
+        print("  shard %d: %d calls in %.2f seconds, %.0f calls/s" %
+              (index, calls, shard_elapsed,
+               calls / shard_elapsed if shard_elapsed else 0.0))
+
+    print("%-24s %8s %10s %10s %10s %10s" %
+          ("method", "calls", "p50 ms", "p90 ms", "p99 ms", "max ms"))
+    for method in METHODS:
+        ms = sorted(v * 1000.0 for v in r['latencies'][method])
+        print("%-24s %8d %10.3f %10.3f %10.3f %10.3f" %
+              (method, len(ms), percentile(ms, 50), percentile(ms, 90),
+               percentile(ms, 99), ms[-1] if ms else 0.0))
+    print("%d AllTheThings failures, %d AllTheThingsDeprecated mismatches, "
+          "%d errors" %
+          (len(r['failures']), len(r['mismatches']), len(r['errors'])))
+
+    for number, method, expected, actual in r['failures']:
+        print("Failed combination %d (shard %d of %d): %s" %
+              (number, number % shards, shards, str(expected)))
+
+
+def check_in_out(bus, object_path, interface, window, workers=1,
+                 only_shard=None, strength=2):
+    """
+    Split the argument matrix over workers processes, or with only_shard
+    (index, count) run just that shard here to reproduce a failure.
+    strength None is exhaustive, otherwise the t of the covering array.
+    """
+    if strength is None:
+        print("Exhaustive, %d combinations" %
+              sum(1 for _ in argument_matrix()))
+    else:
+        print("%d-wise covering array, %d combinations of %d" %
+              (strength, len(list(argument_matrix(strength))),
+               sum(1 for _ in argument_matrix())))
+
+    if only_shard is not None:
+        index, count = only_shard
+        r = Pipeline(bus, object_path, interface, window).run(
+            shard(argument_matrix(strength), index, count))
+        r['shard'] = index
+        r = merge_results([r], r['elapsed'])
+        shards = count
+    elif workers > 1:
+        start = time.monotonic()
+        ctx = multiprocessing.get_context('spawn')
+        with ctx.Pool(workers) as pool:
+            results = pool.starmap(run_shard,
+                                   [(object_path, interface, window, i,
+                                     workers, strength)
+                                    for i in range(workers)])
+        r = merge_results(results, time.monotonic() - start)
+        shards = workers
+    else:
+        r = Pipeline(bus, object_path, interface, window).run(
+            shard(argument_matrix(strength), 0, 1))
+        shards = 1
+
+    pipeline_summary(r, shards)
+    assert not r['failures'] and not r['errors']
+
+
+# Echo methods and the signature of their one argument
+PAYLOAD_METHODS = [("EchoBytes", "ay"), ("EchoDict", "a{sv}"),
+                   ("EchoStructs", "a(sst)"), ("EchoVariant", "v")]
+
+PAYLOAD_SIZES = "16,256,4096,65536,1048576,8388608"
+
+
+def make_payload(method, size):
+    """
+    Returns (value, data bytes) with at least size bytes of data for method,
+    data being string lengths and fixed size values, no D-Bus framing
+    """
+    if method == "EchoBytes":
+        return (bytes(bytearray(range(256))) * (size // 256 + 1))[:size], size
+
+    items = []
+    data = 0
+    i = 0
+    while data < size:
+        if method == "EchoDict":
+            key = dbus.String('key_%08d' % i)
+            if i % 2:
+                items.append((key, dbus.Int64(i)))
+                data += len(key) + 8
+            else:
+                v = dbus.String('value_%08d' % i)
+                items.append((key, v))
+                data += len(key) + len(v)
+        elif method == "EchoStructs":
+            name, v = 'name_%08d' % i, 'value_%08d' % i
+            items.append(dbus.Struct((dbus.String(name), dbus.String(v),
+                                      dbus.UInt64(i)), signature='sst'))
+            data += len(name) + len(v) + 8
+        else:
+            # Variant of an array of variants, each a dict with a variant
+            # of a variant inside
+            name = 'name_%08d' % i
+            items.append(dbus.Dictionary(
+                {'id': dbus.UInt64(i), 'name': dbus.String(name),
+                 'child': dbus.Int32(i, variant_level=2)},
+                signature='sv', variant_level=1))
+            data += len('id') + 8 + len('name') + len(name) + \
+                len('child') + 4
+        i += 1
+
+    if method == "EchoDict":
+        return dbus.Dictionary(items, signature='sv'), data
+    if method == "EchoStructs":
+        return dbus.Array(items, signature='(sst)'), data
+    return dbus.Array(items, signature='v'), data
+
+
+def payload_sweep(bus, object_path, interface, sizes, duration):
+    """
+    Echo each payload size through each method for at least duration
+    seconds, checking every reply.  Returns a list of (method, signature,
+    data bytes, calls, p50 ms, p99 ms, MB/s, failures)
+    """
+    rc = []
+    for method, sig in PAYLOAD_METHODS:
+        for size in sizes:
+            value, data = make_payload(method, size)
+            latencies = []
+            failures = 0
+            start = time.monotonic()
+            while len(latencies) < 3 or time.monotonic() - start < duration:
+                call_start = time.monotonic()
+                result = bus.call_blocking("com.blah.sizecheck", object_path,
+                                           interface, method, sig, (value,),
+                                           timeout=120, byte_arrays=True)
+                latencies.append(time.monotonic() - call_start)
+                if result != value:
+                    failures += 1
+
+            ms = sorted(v * 1000.0 for v in latencies)
+            rate = data * len(latencies) / sum(latencies) / 1e6
+            rc.append((method, sig, data, len(ms), percentile(ms, 50),
+                       percentile(ms, 99), rate, failures))
+            print("%-12s %-7s %10d bytes: %8.2f MB/s%s" %
+                  (method, sig, data, rate,
+                   "" if not failures else ", %d FAILED" % failures),
+                  file=sys.stderr)
+    return rc
+
+
+def payload_summary(rows):
+    print("%-12s %-7s %12s %8s %10s %10s %10s %8s" %
+          ("method", "sig", "data bytes", "calls", "p50 ms", "p99 ms",
+           "MB/s", "check"))
+    for method, sig, data, calls, p50, p99, rate, failures in rows:
+        print("%-12s %-7s %12d %8d %10.3f %10.3f %10.2f %8s" %
+              (method, sig, data, calls, p50, p99, rate,
+               "ok" if not failures else "%d FAIL" % failures))
+
+
+def check_values(name_space, object_path, window, workers, only_shard,
+                 strength=2, payload_sizes=None, payload_time=1.0):
     bus = dbus.SessionBus(mainloop=DBusGMainLoop())
     manager = dbus.Interface(bus.get_object(name_space, object_path),
                              "org.freedesktop.DBus.ObjectManager")
@@ -97,11 +438,61 @@ def check_values(name_space, object_path):
             if interface == "com.blah.sizecheck.Values":
                 print("interface: %s" % interface)
                 properties(props)
-                remote_obj = bus.get_object("com.blah.sizecheck", object_path)
-                iface = dbus.Interface(remote_obj, interface)
-                check_in_out(iface)
+                if payload_sizes:
+                    rows = payload_sweep(bus, object_path, interface,
+                                         payload_sizes, payload_time)
+                    payload_summary(rows)
+                    assert not any(r[-1] for r in rows)
+                else:
+                    check_in_out(bus, object_path, interface, window,
+                                 workers, only_shard, strength)
 
 
 if __name__ == '__main__':
-    check_values("com.blah.sizecheck", "/com/blah/sizecheck")
+    parser = argparse.ArgumentParser(
+        description="Validate values round trip through com.blah.sizecheck")
+    parser.add_argument("--window", type=int, default=64,
+                        help="max outstanding calls (default: %(default)s)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="worker processes, each with its own bus "
+                             "connection (default: %(default)s)")
+    parser.add_argument("--shard", metavar="INDEX/COUNT",
+                        help="run only this shard in process, eg. 2/4 to "
+                             "reproduce a failure from --workers 4")
+    parser.add_argument("--strength", type=int, default=2,
+                        help="t of the t-wise covering array of argument "
+                             "values (default: %(default)s, pairwise)")
+    parser.add_argument("--exhaustive", action="store_true",
+                        help="every combination of argument values instead "
+                             "of a covering array")
+    parser.add_argument("--payload", nargs='?', const=PAYLOAD_SIZES,
+                        metavar="SIZES",
+                        help="echo containers and byte arrays of these "
+                             "comma separated data sizes instead "
+                             "(default: %s)" % PAYLOAD_SIZES)
+    parser.add_argument("--payload-time", type=float, default=1.0,
+                        help="seconds per --payload size and method "
+                             "(default: %(default)s)")
+    args = parser.parse_args()
+
+    sizes = None
+    if args.payload:
+        try:
+            sizes = [int(i) for i in args.payload.split(',')]
+        except ValueError:
+            parser.error("invalid --payload %s" % args.payload)
+
+    only = None
+    if args.shard:
+        try:
+            only = tuple(int(i) for i in args.shard.split('/'))
+            if len(only) != 2 or not 0 <= only[0] < only[1]:
+                raise ValueError()
+        except ValueError:
+            parser.error("invalid --shard %s" % args.shard)
+
+    check_values("com.blah.sizecheck", "/com/blah/sizecheck",
+                 max(1, args.window), max(1, args.workers), only,
+                 None if args.exhaustive else max(1, args.strength), sizes,
+                 args.payload_time)
     sys.exit(0)
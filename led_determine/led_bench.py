@@ -0,0 +1,83 @@
+#!/usr/bin/python3
+
+import cv2
+import numpy as np
+import sys
+import time
+
+import led_determine
+
+# Per frame latency of finding the LED color on stored frames, eg. the ones
+# led_determine.py leaves behind when it can't determine the state.
+#
+# ./led_bench.py mask.png 20240101-120000.jpg [...]
+#
+# The ROI path (warm started, only masked pixels) is a different model from
+# full frame kmeans so its color is not required to match, but the LED state
+# it leads to is, frames where the two classify differently are listed and
+# the exit status is 3.
+
+
+def find_non_black_scan(img_data):
+	# The original per pixel scan, for comparison
+	y_max, x_max = img_data.shape[0:2]
+	for y in range(y_max):
+		for x in range(x_max):
+			b, g, r = img_data[y, x]
+			if b != 0 or g != 0 or r != 0:
+				return (b, g, r)
+	return None
+
+
+def timed(fn, *args):
+	start = time.perf_counter()
+	rc = fn(*args)
+	return rc, (time.perf_counter() - start) * 1000.0
+
+
+if __name__ == "__main__":
+	if len(sys.argv) < 3:
+		print("syntax: <mask image> <frame> [frame ...]")
+		sys.exit(1)
+
+	mask = cv2.imread(sys.argv[1])
+	roi = led_determine.Roi(sys.argv[1])
+	rows = []
+	disagree = []
+	for fn in sys.argv[2:]:
+		frame = cv2.imread(fn)
+		aoi = cv2.bitwise_and(frame, mask)
+
+		# Same kmeans seed for every path so they see the same clusters
+		cv2.setRNGSeed(0)
+		q, quant_ms = timed(led_determine.quantization, aoi)
+		old, scan_ms = timed(find_non_black_scan, q)
+		new, vec_ms = timed(led_determine.find_non_black, q)
+		cv2.setRNGSeed(0)
+		direct, direct_ms = timed(led_determine.quantized_color, aoi)
+
+		if not (old == new == direct):
+			print(f"{fn}: results differ scan {old} vectorised {new} centers {direct}")
+			sys.exit(2)
+		roi_color, roi_ms = timed(roi.color, frame)
+		rows.append((quant_ms, scan_ms, vec_ms, direct_ms, roi_ms))
+		state = led_determine.led_state(direct)
+		roi_state = led_determine.led_state(roi_color)
+		if state != roi_state:
+			disagree.append((fn, state, roi_state))
+		print(f"{fn}: {new} {state} kmeans {quant_ms:.1f} ms, scan {scan_ms:.1f} ms, "
+			f"vectorised {vec_ms:.2f} ms, from centers {direct_ms:.1f} ms, "
+			f"roi {roi_color} {roi_state} {roi_ms:.2f} ms")
+
+	quant_ms, scan_ms, vec_ms, direct_ms, roi_ms = np.median(np.array(rows), axis=0)
+	print(f"\nMedian of {len(rows)} frames")
+	print(f"quantization + per pixel scan  : {quant_ms + scan_ms:10.2f} ms ({scan_ms:.2f} ms scan)")
+	print(f"quantization + vectorised find : {quant_ms + vec_ms:10.2f} ms ({vec_ms:.2f} ms find)")
+	print(f"color from kmeans centers      : {direct_ms:10.2f} ms")
+	print(f"warm started ROI               : {roi_ms:10.2f} ms")
+
+	print(f"\nROI state matches full frame kmeans on {len(rows) - len(disagree)} of {len(rows)} frames")
+	for fn, state, roi_state in disagree:
+		print(f"{fn}: kmeans {state} roi {roi_state}")
+	if disagree:
+		sys.exit(3)
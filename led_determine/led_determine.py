@@ -2,31 +2,129 @@
 
 import cv2
 import numpy as np
-import subprocess
+import queue
+import threading
 import time
-import os
 import sys
 
 
 def find_non_black(img_data):
 	# We should only have 2 colors, black and something else as we did 2 color quantization
-	# which includes the mask, which is black.
-	y_max, x_max = img_data.shape[0:2]
-	for y in range(y_max):
-		for x in range(x_max):
-			b, g, r = img_data[y, x]
-			if b != 0 or g != 0 or r != 0:
-				return (b, g, r)
-	return None
-
+	# which includes the mask, which is black.  First lit pixel in scan order.
+	pixels = img_data.reshape(-1, 3)
+	lit = pixels.any(axis=1)
+	i = np.argmax(lit)
+	if not lit[i]:
+		return None
+	b, g, r = pixels[i]
+	return (b, g, r)
+
+
+class Capture(threading.Thread):
+	# Keeps the V4L2 device open and hands frames to the processing stage in
+	# memory through a bounded queue.  When processing falls behind the oldest
+	# queued frame is dropped, we want the LED state now, not a backlog.
+
+	def __init__(self, device, frames, width=1920, height=1080, skip=40):
+		super().__init__(daemon=True)
+		self.frames = frames
+		self.done = threading.Event()
+		self.cap = cv2.VideoCapture(device, cv2.CAP_V4L2)
+		if not self.cap.isOpened():
+			raise RuntimeError(f"Unable to open {device}")
+		# MJPG so the camera can do 1080p at a useful frame rate
+		self.cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*"MJPG"))
+		self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+		self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+		# Let exposure and white balance settle, like fswebcam -S 40, once
+		for _ in range(skip):
+			self.cap.grab()
+
+	def _put(self, item):
+		while True:
+			try:
+				self.frames.put_nowait(item)
+				return
+			except queue.Full:
+				try:
+					self.frames.get_nowait()
+				except queue.Empty:
+					pass
+
+	def run(self):
+		while not self.done.is_set():
+			ok, frame = self.cap.read()
+			if not ok:
+				break
+			self._put((time.time(), frame))
+		self.cap.release()
+		# Tell the processing stage there is nothing more coming
+		self._put(None)
+
+	def stop(self):
+		self.done.set()
+		self.join()
+
+
+class Roi:
+	# The mask is loaded once and kept as a flat index of the pixels it lets
+	# through, optionally only every step'th row and column of them, so each
+	# frame only looks at those instead of the whole masked 1080p image.
+
+	def __init__(self, mask_img, step=1):
+		mask = cv2.imread(mask_img, cv2.IMREAD_GRAYSCALE)
+		if mask is None:
+			raise ValueError(f"unable to read mask image {mask_img}")
+		self.shape = mask.shape
+		keep = mask != 0
+		if step > 1:
+			grid = np.zeros_like(keep)
+			grid[::step, ::step] = True
+			keep &= grid
+		self.index = np.flatnonzero(keep)
+		self.center = None
+
+	def pixels(self, img):
+		# The index is only meaningful for frames the size of the mask
+		if img.shape[:2] != self.shape:
+			raise ValueError(f"frame is {img.shape[1]}x{img.shape[0]}, mask is "
+				f"{self.shape[1]}x{self.shape[0]}")
+		return np.float32(img.reshape(-1, 3)[self.index])
+
+	def color(self, img, max_iter=10, eps=1.0):
+		# The 2 color quantization of the masked frame is black (the mask, which
+		# dominates the pixel count) and something else.  So this is kmeans
+		# with one center pinned at black, run over the ROI pixels only and
+		# warm started from the previous frame's center.
+		pixels = self.pixels(img)
+		if not len(pixels):
+			return None
+
+		warm = self.center is not None
+		c = self.center if warm else pixels.mean(axis=0)
+		self.center = None
+		for _ in range(max_iter):
+			# Closer to c than to black
+			lit = pixels @ c * 2 > c @ c
+			if not lit.any():
+				if not warm:
+					return None
+				# Previous frame's center is no help, start over
+				warm = False
+				c = pixels.mean(axis=0)
+				continue
+			n = pixels[lit].mean(axis=0)
+			moved = np.abs(n - c).max()
+			c = n
+			if moved <= eps:
+				break
 
-def acquire_image(device, mask_img):
-	image_name = time.strftime("%Y%m%d-%H%M%S") + ".jpg"
-	cmd = ["fswebcam",  "-d", device, "-r",  "1920x1080",  "--jpeg", "100",  "-S", "40", image_name]
-	subprocess.run(cmd, check=True, capture_output=True)
-	org = cv2.imread(image_name)
-	mask = cv2.imread(mask_img)
-	return (cv2.bitwise_and(org, mask), image_name)
+		self.center = c
+		center = np.uint8(c)
+		if not center.any():
+			return None
+		b, g, r = center
+		return (b, g, r)
 
 
 def quantization(img, n_colors=2):
@@ -41,6 +139,22 @@ def quantization(img, n_colors=2):
 	return res.reshape((img.shape))
 
 
+def quantized_color(img, n_colors=2):
+	# Same answer as find_non_black(quantization(img)) straight from the kmeans
+	# centers and labels, without building and scanning the quantized image.
+	pixels = np.float32(img.reshape(-1, 3))
+	criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 10, 1.0)
+
+	ret, label, center = cv2.kmeans(pixels, n_colors, None, criteria, 10, cv2.KMEANS_RANDOM_CENTERS)
+	center = np.uint8(center)
+	lit = center.any(axis=1)[label.flatten()]
+	i = np.argmax(lit)
+	if not lit[i]:
+		return None
+	b, g, r = center[label[i, 0]]
+	return (b, g, r)
+
+
 def led_state(sample):
 	# This is very fragile and prone to error.  This would need lots of work to
 	# be reliable with varying levels/colors of ambient light.
@@ -70,21 +184,34 @@ def led_state(sample):
 
 if __name__ == "__main__":
 
-	while True:
-		(aoi, fn) = acquire_image("/dev/video2", "mask.png")
-		# cv2.imshow("Area of interest", aoi)
-		q = quantization(aoi)
-		color = find_non_black(q)
+	# Optional ROI downsample step, 1 uses every masked pixel
+	step = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+	roi = Roi("mask.png", step)
+
+	frames = queue.Queue(maxsize=2)
+	capture = Capture("/dev/video2", frames)
+	capture.start()
 
-		# If we found the state delete the acquired photo, else dump name and exit
+	while True:
+		item = frames.get()
+		if item is None:
+			print("Frame capture failed")
+			sys.exit(1)
+		(ts, frame) = item
+		# cv2.imshow("Area of interest", cv2.bitwise_and(frame, cv2.imread("mask.png")))
+		color = roi.color(frame)
+
+		# Only write the frame to disk when we can't determine the state, then exit
 		state = led_state(color)
 		if state is not None:
-			os.remove(fn)
 			print(f"{color} = {state}")
 		else:
+			fn = time.strftime("%Y%m%d-%H%M%S", time.localtime(ts)) + ".jpg"
+			cv2.imwrite(fn, frame, [cv2.IMWRITE_JPEG_QUALITY, 100])
 			print(f"Unable to determine state {state} for {fn} {color}")
+			capture.stop()
 			sys.exit(2)
 
-		#cv2.imshow('Quantization', q)
+		#cv2.imshow('Quantization', quantization(cv2.bitwise_and(frame, cv2.imread("mask.png"))))
 		#cv2.waitKey(0)
 		#cv2.destroyAllWindows()
@@ -6,11 +6,83 @@ Prototype signal verification for lvmdbusd and potentially other dbus services.
 Dbus signals when implemented correctly for a service allow a client the ability
 to have its current state updated when it occurs and be totally event driven.
 
-Theory of operation:
+Each monitored service (bus name and object manager path) gets its own
+ServiceMonitor holding its signal db, journal and validation timer.  Any
+number of them share the one system bus connection and GLib main loop, eg.
+
+    oversight.py com.redhat.lvmdbus1:/com/redhat/lvmdbus1 \
+                 org.storage.stratis3:/org/storage/stratis3
+
+Theory of operation (per monitor):
 * Register signal handlers, fetch current state by using GetManagedObjects and
   keep this as the reference db that should only be updated via signals
-* After 3 seconds have elapsed since the last signal, retrieve entire state by
-  calling GetManagedObjects and compare to in memory db.  Log any differences.
+* Every signal is given a monotonic sequence number and goes through one
+  ordered journal.  Signals which arrive before the initial fetch completes
+  are held in the journal and drained exactly once when it does.
+* Every property, interface and object in the signal db has a fingerprint
+  which is updated incrementally as signals arrive and rolled up into a
+  single root digest (a Merkle style tree, children are combined with XOR so
+  one change only touches its own path to the root).  Leaves are blake2b of
+  a canonical type tagged encoding of the value, not the builtin hash() which
+  collides by design (hash(-1) == hash(-2)).
+* Nothing polls.  Each signal (re)arms a validation timer for the quiet
+  window, when it fires before the window has passed it is simply pushed
+  back.  The window adapts to the observed signal inter-arrival times
+  (QUIET_FACTOR times their moving average, between QUIET_MIN and QUIET_MAX
+  seconds).  Under sustained load that never goes quiet a validation is
+  forced MAX_DEFER seconds after the first unvalidated signal; it is tied to
+  the current sequence point and anything changed after it is skipped.
+* Once the window has passed with no signals, retrieve entire state by
+  calling GetManagedObjects asynchronously and compare to in memory db when
+  the reply arrives.  The reply is fingerprinted the same way, if the root
+  digests match we are done, otherwise we follow the tree down and only
+  compare the objects and interfaces whose digests differ.  Log any
+  differences.  Anything touched by a signal while the call is outstanding is
+  skipped and left for the next validation.  Every FULL_SWEEP_INTERVAL
+  validations (or on SIGUSR1) every object is compared field by field.
+* The comparison is split into slices run from idle callbacks, a bounded
+  number of objects or amount of time each, so signals keep being processed
+  while we validate.  The longest slice and the worst main loop stall (seen
+  by a heartbeat timer) are reported with each validation.
+
+PropertiesChanged is received through a bus match rule restricted to the
+service's sender and path_namespace (optionally arg0namespace for interfaces,
+given as a third field eg. bus_name:path:arg0namespace),
+so the bus daemon drops unrelated signals from other services before they
+ever wake us up.  Each signal is handed to the monitor whose service owns
+the sender (tracked with NameOwnerChanged) and whose namespace it is in.
+To see how much that saves, --measure-unfiltered also adds the broad rule
+add_signal_receiver would have used (every PropertiesChanged on the bus) and
+counts what it delivers against the signals the monitors actually use; the
+narrow rules are then re-checked in python.
+
+Signal db: values are converted once to plain python types when they arrive.
+Interface and property names are interned and every interface has a single
+property name schema shared by all objects, each object stores a list of
+values per interface indexed by that schema rather than a dict of dbus-python
+wrapper objects.  "oversight.py --memory-report N" compares the two on N
+synthetic objects.
+
+Logging is buffered and written from an idle callback as text or JSON lines
+(--log-format).  Signal traffic is logged at debug level and by default only
+kept in a ring buffer (--log-ring records) which is written out as context
+when an error is logged, so a steady state run costs next to nothing.
+
+Metrics: --metrics-file FILE rewrites a Prometheus text format file every
+--metrics-interval seconds and/or --metrics-port PORT serves the same text
+over HTTP on localhost from the main loop.  Signal counts by type, journal
+and in flight depth, validation duration histogram, objects and properties
+tracked, errors, main loop stall and RSS are exported.
+
+Capture and replay:
+    oversight.py --record trace.gz [services ...]
+records the initial GetManagedObjects snapshot, every InterfacesAdded,
+InterfacesRemoved and PropertiesChanged signal with its timestamp and every
+validation request and reply to a gzip'd stream of pickled records.
+
+    oversight.py --replay trace.gz [--fast]
+feeds a recording through the same handlers and validator without a bus,
+either at the original timing or as fast as possible.
 
 Note: Entire execution of code is event driven utilizing the GLib main context
       and timers.  Code is inherently single threaded with this approach.
@@ -37,46 +109,206 @@ To induce a delay before teardown, to allow this process the ability to handle
 outstanding signals and do a comparison.
 
 """
-import copy
+import argparse
+import atexit
+import collections
+import gzip
+import hashlib
+import json
 import os
+import pickle
+import signal
+import socket
+import struct
 import sys
 import time
 import traceback
+import tracemalloc
 
 import dbus
+import dbus.lowlevel
 import dbus.mainloop.glib
 from gi.repository import GLib
 
 OBJECT_MANAGER = "org.freedesktop.DBus.ObjectManager"
 BUS_NAME = "com.redhat.lvmdbus1"
 SRV_PATH = "/com/redhat/lvmdbus1"
+PROPERTIES = "org.freedesktop.DBus.Properties"
+
+# Every FULL_SWEEP_INTERVAL validations we compare everything field by field
+# regardless of the digests, 0 to disable.
+FULL_SWEEP_INTERVAL = 10
+
+# Generous, a large lvmdbusd can take a while to build the reply
+GET_MANAGED_OBJECTS_TIMEOUT = 120
+
+# The comparison is done from idle callbacks, each one handles at most this
+# many objects or runs for this many seconds before giving the main loop back.
+VALIDATION_SLICE_OBJECTS = 500
+VALIDATION_SLICE_TIME = 0.02
+sliced_validation = True
+
+# Validation duration histogram buckets, seconds
+VALIDATION_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# Quiet window before validating, QUIET_FACTOR times the moving average of
+# signal inter-arrival times (gaps of QUIET_MAX or more are not bursts and
+# are ignored) clamped to QUIET_MIN..QUIET_MAX seconds.
+QUIET_MIN = 0.25
+QUIET_MAX = 3.0
+QUIET_FACTOR = 10
+QUIET_ALPHA = 0.2
+
+# Validate anyway when signals haven't stopped for this many seconds
+MAX_DEFER = 30.0
+
+# Failed GetManagedObjects calls are retried after a delay starting at the
+# quiet window and doubling with each consecutive failure up to this
+RETRY_MAX = 300.0
+
+# Longest we have seen the main loop go without servicing the heartbeat,
+# which only runs while a validation is in progress.
+HEARTBEAT_MS = 100
+max_loop_stall = 0
+last_heartbeat = 0
+heartbeat_id = None
+
+# Shared by all the monitors
+bus = None
+monitors = []
+recorder = None
+replaying = False
+metrics_file = None
+
+# With --measure-unfiltered, PropertiesChanged signals a broad
+# add_signal_receiver style rule delivers, each monitor counts the ones it
+# actually used.
+measure_unfiltered = False
+signals_unfiltered = 0
 
-initial_fetch_complete = False
-objects = dict()
-
-pending_objects = []
-pending_add = []
-pending_rm = []
-pending_update = []
-
-last_update = 0
-dirty = False
-last_log = time.time()
 errors = 0
-invalidated = dict()
 
-
-def log_error(msg):
+DEBUG = 10
+INFO = 20
+ERROR = 40
+LOG_LEVELS = {"debug": DEBUG, "info": INFO, "error": ERROR}
+LOG_LEVEL_NAMES = {v: k for k, v in LOG_LEVELS.items()}
+
+
+class Logger(object):
+    """
+    Buffered logger.  Records are (timestamp, level, format, args) and are
+    only formatted when written.  Records at or above the level are queued
+    and written as text or JSON lines from a low priority idle callback.
+    Records below the level go into a ring buffer which is only written out,
+    as context, when an error is logged.
+    """
+
+    # Write synchronously if this many records are queued, eg. no main loop
+    FLUSH_RECORDS = 4096
+
+    def __init__(self, level=INFO, json_lines=False, ring_size=1000, out=sys.stdout):
+        self.level = level
+        self.json_lines = json_lines
+        self.out = out
+        self.pending = []
+        self.ring = collections.deque(maxlen=ring_size)
+        self.flush_scheduled = False
+        self.last = time.time()
+
+    def resize_ring(self, ring_size):
+        self.ring = collections.deque(self.ring, maxlen=ring_size)
+
+    def write(self, level, msg, args):
+        r = (time.time(), level, msg, args)
+        if level < self.level:
+            self.ring.append(r)
+            return
+
+        if level >= ERROR:
+            if self.ring:
+                self.pending.append(
+                    (r[0], INFO, "---- %d records of recent history ----", (len(self.ring),))
+                )
+                self.pending.extend(self.ring)
+                self.ring.clear()
+            self.pending.append(r)
+            self.flush()
+            return
+
+        self.pending.append(r)
+        if len(self.pending) >= Logger.FLUSH_RECORDS:
+            self.flush()
+        elif not self.flush_scheduled:
+            self.flush_scheduled = True
+            GLib.idle_add(self._flush_idle, priority=GLib.PRIORITY_LOW)
+
+    def _format(self, r):
+        ts, level, msg, args = r
+        text = msg % args if args else msg
+        if self.json_lines:
+            return json.dumps({"ts": ts, "level": LOG_LEVEL_NAMES[level], "msg": text})
+        line = "[%f][%f]: %s" % (ts, ts - self.last, text)
+        self.last = ts
+        return line
+
+    def flush(self):
+        if self.pending:
+            pending = self.pending
+            self.pending = []
+            self.out.write("\n".join(self._format(r) for r in pending) + "\n")
+            self.out.flush()
+
+    def _flush_idle(self):
+        self.flush_scheduled = False
+        self.flush()
+        return False
+
+
+logger = Logger()
+
+
+def log_error(msg, *args):
     global errors
     errors += 1
-    log(msg)
+    logger.write(ERROR, msg, args)
+
 
+def log_exception(msg, *args):
+    # Current exception's traceback as part of the error record, so it gets
+    # the ring context and the json format like everything else
+    log_error(msg + "\n%s", *(args + (traceback.format_exc().rstrip(),)))
 
-def log(msg):
-    global last_log
-    n = time.time()
-    print("[%f][%f]: %s" % (n, n - last_log, msg))
-    last_log = n
+
+def log(msg, *args):
+    logger.write(INFO, msg, args)
+
+
+def log_debug(msg, *args):
+    logger.write(DEBUG, msg, args)
+
+
+class _ObjectText(object):
+    """
+    Defers formatting an object's interfaces and properties until, and
+    unless, the log record is written.
+    """
+
+    def __init__(self, interfaces):
+        self.interfaces = interfaces
+
+    def __str__(self):
+        return "; ".join(
+            "%s: %s"
+            % (
+                intf,
+                ", ".join(
+                    "%s=%s" % (prop, str(val))
+                    for prop, val in sorted(values.items(), key=lambda x: x[0])
+                ),
+            )
+            for intf, values in sorted(self.interfaces.items(), key=lambda x: x[0])
+        )
 
 
 def dump_object(object_path, interfaces):
@@ -90,132 +322,1421 @@ def dump_object(object_path, interfaces):
 
 
 def dump():
-    global objects
+    for m in monitors:
+        m.dump()
+
+
+def _native(v):
+    """
+    Convert a dbus-python value to plain python types, dbus.Boolean has to be
+    checked before the integer types as it's an int too.
+    """
+    if isinstance(v, (bool, dbus.Boolean)):
+        return bool(v)
+    if isinstance(v, (dbus.String, dbus.ObjectPath, dbus.Signature)):
+        return str(v)
+    if isinstance(v, int):
+        return int(v)
+    if isinstance(v, float):
+        return float(v)
+    if isinstance(v, bytes):
+        return bytes(v)
+    if isinstance(v, dict):
+        return {_native(k): _native(ev) for k, ev in v.items()}
+    if isinstance(v, tuple):
+        return tuple(_native(i) for i in v)
+    if isinstance(v, list):
+        return [_native(i) for i in v]
+    return v
+
+
+class Recorder(object):
+    """
+    Writes (kind, timestamp, service, data) records to a gzip'd pickle stream.
+    """
+
+    VERSION = 1
+
+    def __init__(self, file_name):
+        self.f = gzip.open(file_name, "wb")
+        self.count = 0
+        self.record("header", None, Recorder.VERSION)
+
+    def record(self, kind, service, *data):
+        pickle.dump(
+            (kind, time.time(), service, _native(data)),
+            self.f,
+            pickle.HIGHEST_PROTOCOL,
+        )
+        self.count += 1
+
+    def close(self):
+        self.f.close()
+
+
+def read_records(file_name):
+    with gzip.open(file_name, "rb") as f:
+        kind, _, _, data = pickle.load(f)
+        if kind != "header" or data[0] != Recorder.VERSION:
+            raise ValueError("%s is not a supported recording" % file_name)
+
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+
+# Schema slot with no value for a given object
+_MISSING = object()
+
+# Bytes of blake2b used for every fingerprint
+DIGEST_SIZE = 16
+
+
+def _encode(v, out):
+    """
+    Canonical, type tagged encoding of a (native) value appended to out,
+    dictionaries are encoded in key order so it's order independent.
+    """
+    if v is None:
+        out += b'N'
+    elif isinstance(v, bool):
+        out += b'T' if v else b'F'
+    elif isinstance(v, int):
+        out += b'I%d;' % v
+    elif isinstance(v, float):
+        out += b'D' + struct.pack('<d', v)
+    elif isinstance(v, str):
+        b = v.encode('utf-8', 'surrogatepass')
+        out += b'S%d:' % len(b) + b
+    elif isinstance(v, (bytes, bytearray)):
+        out += b'Y%d:' % len(v) + bytes(v)
+    elif isinstance(v, (list, tuple)):
+        out += b'L%d:' % len(v)
+        for i in v:
+            _encode(i, out)
+    elif isinstance(v, dict):
+        items = []
+        for k, ev in v.items():
+            kb = bytearray()
+            _encode(k, kb)
+            vb = bytearray()
+            _encode(ev, vb)
+            items.append((bytes(kb), bytes(vb)))
+        out += b'M%d:' % len(items)
+        for kb, vb in sorted(items):
+            out += kb + vb
+    else:
+        _encode(str(v), out)
+
+
+def _digest(data):
+    return int.from_bytes(hashlib.blake2b(bytes(data),
+                                          digest_size=DIGEST_SIZE).digest(),
+                          'little')
+
+
+def _prop_hash(prop, value):
+    out = bytearray(b'P')
+    _encode(str(prop), out)
+    _encode(_native(value), out)
+    return _digest(out)
+
+
+def _child_hash(name, digest):
+    out = bytearray(b'C')
+    _encode(str(name), out)
+    out += digest.to_bytes(DIGEST_SIZE, 'little')
+    return _digest(out)
+
+
+def _interface_digest(props):
+    d = 0
+    for prop, value in props.items():
+        d ^= _prop_hash(prop, value)
+    return d
+
+
+def _fingerprint_object(interfaces):
+    """
+    Returns (object digest, {interface: interface digest})
+    """
+    obj_digest = 0
+    intf_digests = dict()
+    for interface, props in interfaces.items():
+        d = _interface_digest(props)
+        intf_digests[interface] = d
+        obj_digest ^= _child_hash(interface, d)
+    return obj_digest, intf_digests
+
+
+def _fingerprint(objects):
+    """
+    Returns (root digest, {object path: (object digest,
+    {interface: interface digest})}) for a GetManagedObjects reply.
+    """
+    root = 0
+    digests = dict()
+    for object_path, interfaces in objects.items():
+        digests[object_path] = _fingerprint_object(interfaces)
+        root ^= _child_hash(object_path, digests[object_path][0])
+    return root, digests
+
+
+# Values the builtin hash() can't tell apart, the fingerprints have to
+FINGERPRINT_CHECKS = [(-1, -2), (0, 2**61 - 1), (1, True), (0, 0.0),
+                      ('', b''), ([1, 2], [2, 1])]
+
+
+def check_fingerprints():
+    """
+    Sanity check for --self-test, a collision here means a real difference
+    would validate as in sync.
+    """
+    for a, b in FINGERPRINT_CHECKS:
+        if _prop_hash('p', a) == _prop_hash('p', b):
+            raise AssertionError("property fingerprint collision %r %r" %
+                                 (a, b))
+        if _fingerprint({'/o': {'i': {'p': a}}})[0] == \
+                _fingerprint({'/o': {'i': {'p': b}}})[0]:
+            raise AssertionError("root fingerprint collision %r %r" % (a, b))
+
+
+class SignalDb(object):
+    """
+    Compact store of object path -> interface -> values.  The property names
+    for an interface live in a schema shared by every object, objects only
+    hold a list of values in schema order.
+
+    Alongside the values we keep the interface and object digests and the
+    root digest, see _fingerprint.
+    """
+
+    # interface -> (list of property names, property name -> index)
+    _schemas = dict()
+
+    def __init__(self, objects=None):
+        self._objects = dict()
+        # object path -> [object digest, {interface: interface digest}]
+        self._digests = dict()
+        self.root = 0
+        self.property_count = 0
+        if objects:
+            for object_path, interfaces in objects.items():
+                self.set_object(object_path, interfaces)
+
+    @staticmethod
+    def _schema(interface):
+        schema = SignalDb._schemas.get(interface)
+        if schema is None:
+            schema = ([], dict())
+            SignalDb._schemas[sys.intern(str(interface))] = schema
+        return schema
+
+    @staticmethod
+    def _slot(schema, prop):
+        idx = schema[1].get(prop)
+        if idx is None:
+            idx = len(schema[0])
+            prop = sys.intern(str(prop))
+            schema[0].append(prop)
+            schema[1][prop] = idx
+        return idx
+
+    @staticmethod
+    def _count(values):
+        return sum(1 for v in values if v is not _MISSING)
+
+    def _pack(self, interface, props):
+        schema = SignalDb._schema(interface)
+        values = [_MISSING] * len(schema[0])
+        for prop, value in props.items():
+            idx = SignalDb._slot(schema, prop)
+            if idx >= len(values):
+                values.extend([_MISSING] * (idx + 1 - len(values)))
+            values[idx] = _native(value)
+        return values
+
+    def __contains__(self, object_path):
+        return object_path in self._objects
+
+    def __len__(self):
+        return len(self._objects)
+
+    def paths(self):
+        return self._objects.keys()
+
+    def interfaces(self, object_path):
+        return self._objects[object_path].keys()
+
+    def properties(self, object_path, interface):
+        names = SignalDb._schemas[interface][0]
+        return {
+            names[i]: v
+            for i, v in enumerate(self._objects[object_path][interface])
+            if v is not _MISSING
+        }
+
+    def object(self, object_path):
+        return {
+            interface: self.properties(object_path, interface)
+            for interface in self._objects[object_path]
+        }
+
+    def items(self):
+        for object_path in self._objects:
+            yield object_path, self.object(object_path)
+
+    def object_digest(self, object_path):
+        return self._digests[object_path][0]
+
+    def interface_digest(self, object_path, interface):
+        return self._digests[object_path][1][interface]
+
+    def _set_object_digest(self, object_path, digests, obj_digest):
+        self.root ^= _child_hash(object_path, digests[0])
+        digests[0] = obj_digest
+        self.root ^= _child_hash(object_path, obj_digest)
+
+    def set_object(self, object_path, interfaces):
+        object_path = sys.intern(str(object_path))
+        if object_path in self._digests:
+            self.root ^= _child_hash(object_path, self._digests[object_path][0])
+            for values in self._objects[object_path].values():
+                self.property_count -= SignalDb._count(values)
+
+        entry = dict()
+        intf_digests = dict()
+        obj_digest = 0
+        for i, props in interfaces.items():
+            i = sys.intern(str(i))
+            entry[i] = self._pack(i, props)
+            self.property_count += len(props)
+            d = _interface_digest(props)
+            intf_digests[i] = d
+            obj_digest ^= _child_hash(i, d)
+
+        self._objects[object_path] = entry
+        self._digests[object_path] = [obj_digest, intf_digests]
+        self.root ^= _child_hash(object_path, obj_digest)
+
+    def remove_interfaces(self, object_path, interfaces):
+        """
+        Returns True when the object no longer has any interfaces and has been
+        removed.
+        """
+        entry = self._objects[object_path]
+        digests = self._digests[object_path]
+        obj_digest = digests[0]
+        for interface in interfaces:
+            self.property_count -= SignalDb._count(entry.pop(interface))
+            obj_digest ^= _child_hash(interface, digests[1].pop(interface))
+
+        if not entry:
+            self.root ^= _child_hash(object_path, digests[0])
+            del self._objects[object_path]
+            del self._digests[object_path]
+            return True
+
+        self._set_object_digest(object_path, digests, obj_digest)
+        return False
+
+    def update(self, object_path, interface, changed):
+        values = self._objects[object_path][interface]
+        schema = SignalDb._schema(interface)
+        digests = self._digests[object_path]
+        old_digest = d = digests[1][interface]
+
+        for prop, value in changed.items():
+            idx = SignalDb._slot(schema, prop)
+            if idx >= len(values):
+                values.extend([_MISSING] * (idx + 1 - len(values)))
+            if values[idx] is _MISSING:
+                self.property_count += 1
+            else:
+                d ^= _prop_hash(prop, values[idx])
+            values[idx] = _native(value)
+            d ^= _prop_hash(prop, values[idx])
+
+        digests[1][interface] = d
+        self._set_object_digest(
+            object_path,
+            digests,
+            digests[0]
+            ^ _child_hash(interface, old_digest)
+            ^ _child_hash(interface, d),
+        )
+
 
-    if initial_fetch_complete:
-        log("**** Dumping signal db")
-        for obj_path, info in objects.items():
+def _synthetic_objects(count):
+    """
+    Roughly what an lvmdbusd LV looks like on the bus.
+    """
+    rc = dict()
+    for i in range(count):
+        object_path = dbus.ObjectPath("/com/redhat/lvmdbus1/Lv/%d" % i)
+        rc[object_path] = dbus.Dictionary(
+            {
+                dbus.String("com.redhat.lvmdbus1.LvCommon"): dbus.Dictionary(
+                    {
+                        dbus.String("Name"): dbus.String("lv_%d" % i),
+                        dbus.String("Uuid"): dbus.String(
+                            "kQ1BLF-iBTn-FiHR-x8yI-DEqt-%010d" % i
+                        ),
+                        dbus.String("SizeBytes"): dbus.UInt64(4194304 * i),
+                        dbus.String("Vg"): dbus.ObjectPath("/com/redhat/lvmdbus1/Vg/0"),
+                        dbus.String("Tags"): dbus.Array(
+                            [dbus.String("tag_a"), dbus.String("tag_b")],
+                            signature="s",
+                        ),
+                        dbus.String("Active"): dbus.Boolean(True),
+                        dbus.String("IsThinVolume"): dbus.Boolean(False),
+                        dbus.String("DataPercent"): dbus.UInt32(0),
+                        dbus.String("Attr"): dbus.Struct(
+                            (dbus.String("-wi-a-----"), dbus.String("")),
+                            signature="ss",
+                        ),
+                        dbus.String("Devices"): dbus.Array(
+                            [
+                                dbus.Struct(
+                                    (
+                                        dbus.ObjectPath("/com/redhat/lvmdbus1/Pv/0"),
+                                        dbus.Array(
+                                            [
+                                                dbus.Struct(
+                                                    (dbus.UInt64(0), dbus.UInt64(i)),
+                                                    signature="tt",
+                                                )
+                                            ],
+                                            signature="(tt)",
+                                        ),
+                                    ),
+                                    signature="oa(tt)",
+                                )
+                            ],
+                            signature="(oa(tt))",
+                        ),
+                    },
+                    signature="sv",
+                ),
+                dbus.String("com.redhat.lvmdbus1.Lv"): dbus.Dictionary(
+                    {
+                        dbus.String("OriginLv"): dbus.ObjectPath("/"),
+                        dbus.String("PoolLv"): dbus.ObjectPath("/"),
+                        dbus.String("HiddenLvs"): dbus.Array([], signature="o"),
+                    },
+                    signature="sv",
+                ),
+            },
+            signature="sa{sv}",
+        )
+    return rc
+
+
+def memory_report(count):
+    """
+    Compare the memory used by the signal db as nested dicts of dbus-python
+    wrappers vs. SignalDb for count synthetic objects.
+    """
+    tracemalloc.start()
+
+    base = tracemalloc.get_traced_memory()[0]
+    wrapped = _synthetic_objects(count)
+    wrapped_size = tracemalloc.get_traced_memory()[0] - base
+
+    base = tracemalloc.get_traced_memory()[0]
+    compact = SignalDb(wrapped)
+    compact_size = tracemalloc.get_traced_memory()[0] - base
+
+    tracemalloc.stop()
+
+    print("Objects                  : %d" % len(compact))
+    print(
+        "dbus-python dicts        : %d bytes (%d per object)"
+        % (wrapped_size, wrapped_size / count)
+    )
+    print(
+        "SignalDb                 : %d bytes (%d per object)"
+        % (compact_size, compact_size / count)
+    )
+    print("Ratio                    : %.2f" % (float(wrapped_size) / compact_size))
+
+
+def _add_entry(entries, object_path, interface):
+    if interface is None:
+        entries[object_path] = None
+    else:
+        interfaces = entries.setdefault(object_path, set())
+        if interfaces is not None:
+            interfaces.add(interface)
+
+
+def _properties_match_rule(bus_name, path, arg0namespace=None):
+    rule = (
+        "type='signal',sender='%s',interface='%s',"
+        "member='PropertiesChanged',path_namespace='%s'"
+        % (bus_name, PROPERTIES, path)
+    )
+    if arg0namespace:
+        rule += ",arg0namespace='%s'" % arg0namespace
+    return rule
+
+
+# What add_signal_receiver(dbus_interface=PROPERTIES,
+# signal_name="PropertiesChanged") would have added
+UNFILTERED_PROPERTIES_RULE = (
+    "type='signal',interface='%s',member='PropertiesChanged'" % PROPERTIES
+)
+
+
+def _unfiltered_note():
+    if not measure_unfiltered:
+        return ""
+    return ", unfiltered rule delivered %d" % signals_unfiltered
+
+
+def _properties_filter(connection, msg):
+    global signals_unfiltered
+
+    # dbus-python's add_signal_receiver can't express path_namespace or
+    # arg0namespace, so we add the match rules ourselves and pick the signals
+    # off the connection with a message filter, handing each one to the
+    # monitor of the sending service whose namespace it is in.  Namespaces
+    # can overlap (a monitor on / matches every path), so the sender has to
+    # match too and the most specific namespace wins.
+    if (
+        isinstance(msg, dbus.lowlevel.SignalMessage)
+        and msg.get_member() == "PropertiesChanged"
+        and msg.get_interface() == PROPERTIES
+    ):
+        if measure_unfiltered:
+            signals_unfiltered += 1
+        sender = msg.get_sender()
+        object_path = msg.get_path()
+        args = msg.get_args_list()
+        target = None
+        for m in monitors:
+            if (
+                m.matches(sender, object_path, args[0])
+                and (target is None or len(m.srv_path) > len(target.srv_path))
+            ):
+                target = m
+        if target is not None:
+            target.properties_changed(*args, object_path=object_path)
+
+    return dbus.lowlevel.HANDLER_RESULT_NOT_YET_HANDLED
+
+
+class ServiceMonitor(object):
+    """
+    Signal db and validation state for one object manager service.
+    """
+
+    def __init__(self, the_bus, bus_name, srv_path, arg0namespace=None):
+        self.bus = the_bus
+        self.bus_name = bus_name
+        self.srv_path = srv_path
+        self.arg0namespace = arg0namespace
+        # Unique name currently owning bus_name, signals are routed on it
+        self.owner = None
+
+        self.initial_fetch_complete = False
+        self.objects = SignalDb()
+
+        # Ordered journal of (sequence, apply function, args) for signals we
+        # have received but not yet applied to the signal db.
+        self.journal = collections.deque()
+        self.signal_seq = 0  # Last sequence number handed out
+        self.applied_seq = 0  # Last sequence number applied to the signal db
+        self.fetch_seq = 0  # signal_seq when the initial fetch was issued
+
+        self.last_update = 0
+        self.dirty = False
+        self.dirty_since = 0
+        self.interarrival = None  # Moving average, seconds
+        self.timer = None
+
+        self.validation_count = 0
+        self.full_sweep_requested = False
+
+        # Backoff after GetManagedObjects failures, 0 when the last one worked
+        self.retry_delay = 0
+        self.retry_at = 0
+
+        # Validation GetManagedObjects call is outstanding, any signals which
+        # arrive in this window are recorded in in_flight_set (object path ->
+        # set of interfaces, None for the whole object) as the reply may or
+        # may not reflect them.
+        self.validation_in_flight = False
+        self.validation_start = 0
+        self.in_flight_set = dict()
+        self.validation_full_sweep = False
+        self.validation_seq = 0  # applied_seq when the validation was issued
+
+        # Comparison in progress, see _validation_slice
+        self.validation_reply = None
+        self.validation_steps = None
+        self.validation_slices = 0
+        self.validation_max_slice = 0
+
+        self.signals_used = 0
+        self.invalidated = dict()
+
+        # For metrics, signal type -> count and validation duration histogram
+        self.signal_counts = collections.Counter()
+        self.validation_buckets = [0] * len(VALIDATION_BUCKETS)
+        self.validation_sum = 0.0
+        self.validation_count_done = 0
+
+    def __str__(self):
+        return "%s:%s" % (self.bus_name, self.srv_path)
+
+    def _record(self, kind, *data):
+        if recorder:
+            recorder.record(kind, str(self), *data)
+
+    def in_namespace(self, object_path):
+        return (
+            self.srv_path == "/"
+            or object_path == self.srv_path
+            or object_path.startswith(self.srv_path + "/")
+        )
+
+    def matches(self, sender, object_path, interface):
+        """
+        Would our PropertiesChanged match rule let this signal through
+        """
+        if sender != self.owner or not self.in_namespace(object_path):
+            return False
+        ns = self.arg0namespace
+        return not ns or interface == ns or interface.startswith(ns + ".")
+
+    def _owner_changed(self, new_owner):
+        new_owner = str(new_owner) or None
+        if new_owner == self.owner:
+            return
+        log("%s owner changed %s -> %s" % (self, self.owner, new_owner))
+        self._record("owner", new_owner)
+        self.owner = new_owner
+
+        # A restart shows up as old -> None then None -> new.  Whatever we
+        # have describes the previous owner, so forget it and for a new owner
+        # start over like at start up, journaling until the fetch completes.
+        self._forget_objects()
+        if new_owner and not replaying:
+            GLib.idle_add(self._refetch)
+
+    def _forget_objects(self):
+        self.initial_fetch_complete = False
+        self.objects = SignalDb()
+        self.journal.clear()
+        self.invalidated = dict()
+        self.dirty = False
+        self.retry_delay = 0
+        self.retry_at = 0
+        if self.timer is not None:
+            GLib.source_remove(self.timer)
+            self.timer = None
+
+        # A validation against the old owner's objects means nothing now
+        self.in_flight_set = dict()
+        self.validation_in_flight = False
+        self.validation_reply = None
+        self.validation_steps = None
+
+    def _refetch(self):
+        self.get_objects()
+        # Whatever it has now has to be compared in full once fetched
+        self.request_full_sweep()
+        return False
+
+    def start(self):
+        try:
+            self.owner = str(self.bus.get_name_owner(self.bus_name))
+        except dbus.DBusException:
+            self.owner = None
+        self.bus.watch_name_owner(self.bus_name, self._owner_changed)
+
+        # Register for main signals
+        dobj = self.bus.get_object(self.bus_name, self.srv_path)
+        dobj.connect_to_signal(
+            dbus_interface=OBJECT_MANAGER,
+            signal_name="InterfacesAdded",
+            handler_function=self.object_manager_add,
+        )
+
+        dobj.connect_to_signal(
+            dbus_interface=OBJECT_MANAGER,
+            signal_name="InterfacesRemoved",
+            handler_function=self.object_manager_remove,
+        )
+
+        self.bus.add_match_string_non_blocking(
+            _properties_match_rule(self.bus_name, self.srv_path, self.arg0namespace)
+        )
+
+        # There is an inherent race condition between fetching all the objects
+        # and having the signal handlers in place.  We will install signal
+        # handlers and schedule the object retrieval to occur when the main
+        # event loop is idle.  This way the main loop is up and processing
+        # events before we retrieve the entire object state.
+        GLib.idle_add(self.get_objects)
+
+    def dump(self):
+        if self.initial_fetch_complete:
+            log("**** Dumping signal db %s" % self)
+            for obj_path, info in self.objects.items():
+                dump_object(obj_path, info)
+
+        log("**** Dumping GetManagedObjects %s" % self)
+        try:
+            c = self._get_managed_objects()
+        except dbus.DBusException:
+            log_exception("%s unable to dump GetManagedObjects", self)
+            return
+        for obj_path, info in c.items():
             dump_object(obj_path, info)
 
-    log("**** Dumping GetManagedObjects")
-    sys_bus = dbus.SystemBus()
-    c = _get_managed_objects(sys_bus)
-    for obj_path, info in c.items():
-        dump_object(obj_path, info)
+    def _mark_dirty(self, object_path, interface=None):
+        if self.validation_in_flight:
+            _add_entry(self.in_flight_set, object_path, interface)
 
+    def _do_prop_update(self, object_path, interface, changed, invalid):
+        self._mark_dirty(object_path, interface)
 
-def _do_prop_update(object_path, interface, changed, invalid):
-    global objects
-    global invalidated
+        for prop, new_value in changed.items():
+            log_debug(
+                "SIGNAL prop. change: %s[%s][%s] = %s",
+                object_path,
+                interface,
+                prop,
+                new_value,
+            )
+        self.objects.update(object_path, interface, changed)
 
-    for prop, new_value in changed.items():
-        log("SIGNAL prop. change: %s[%s][%s] = %s" % (object_path, interface, prop, str(new_value)))
-        objects[object_path][interface][prop] = new_value
+        if invalid and len(invalid) > 0:
+            log_debug(
+                "SIGNAL: %s[%s] invalidated: [%s]", object_path, interface, invalid
+            )
+            self.invalidated.setdefault(object_path + interface, []).extend(invalid)
+
+    def _mark_signal(self):
+        now = time.time()
+        if self.last_update:
+            gap = now - self.last_update
+            if gap < QUIET_MAX:
+                if self.interarrival is None:
+                    self.interarrival = gap
+                else:
+                    self.interarrival += QUIET_ALPHA * (gap - self.interarrival)
+        self.last_update = now
+
+        if not self.dirty:
+            self.dirty = True
+            self.dirty_since = now
+        self._arm_timer()
+
+    def quiet_window(self):
+        if self.interarrival is None:
+            return QUIET_MAX
+        return min(QUIET_MAX, max(QUIET_MIN, QUIET_FACTOR * self.interarrival))
+
+    def _arm_timer(self, delay=None):
+        if replaying or self.timer is not None or errors > 0:
+            return
+        if delay is None:
+            delay = self.quiet_window()
+        self.timer = GLib.timeout_add(max(1, int(delay * 1000)), self._timer_expired)
+
+    def _timer_expired(self):
+        self.timer = None
+
+        # Validation completion re-arms us if there is more to do
+        if (
+            errors > 0
+            or not self.dirty
+            or not self.initial_fetch_complete
+            or self.validation_in_flight
+        ):
+            return False
 
-    if invalid and len(invalid) > 0:
-        log("SIGNAL: %s[%s] invalidated: [%s]" % ((object_path, interface, ",".join(invalid))))
-        invalidated.setdefault(object_path + interface, []).extend(invalid)
+        # It's difficult to determine that any given state is correct if things
+        # are rapidly changing.  We will wait until we haven't gotten any
+        # signals for a while and we will then compare what the object manager
+        # retrieves vs. what we have gotten via signals.  They should match if
+        # all the signals are being delivered as needed.  If it never goes
+        # quiet we take a snapshot anyway, at a known sequence point.
+        now = time.time()
+        if now < self.retry_at:
+            self._arm_timer(self.retry_at - now)
+            return False
 
+        quiet_at = self.last_update + self.quiet_window()
+        force_at = self.dirty_since + MAX_DEFER
+        if now < quiet_at and now < force_at:
+            self._arm_timer(min(quiet_at, force_at) - now)
+            return False
 
-def properties_changed(*args, **kwargs):
+        self.begin_validation(forced=now < quiet_at)
 
-    global objects
-    global pending_update
-    global last_update
-    global dirty
+        # The reply is processed by the main loop, signals keep flowing
+        # while the service builds it.
+        try:
+            self._get_managed_objects_async(
+                self._validation_reply, self._validation_error
+            )
+        except:
+            log_exception("%s unable to start validation", self)
+            self.validation_in_flight = False
+        return False
 
-    # Is there a better way to do this without requiring registering a
-    # signal handler for every object?
-    if kwargs["object_path"].startswith(SRV_PATH):
-        last_update = time.time()
-        dirty = True
+    def _journal_signal(self, apply_fn, *args):
+        self._mark_signal()
 
-        object_path = kwargs["object_path"]
-        interface = args[0]
-        changed = args[1]
-        invalid = args[2]
+        self.signal_seq += 1
+        if self.initial_fetch_complete:
+            apply_fn(*args)
+            self.applied_seq = self.signal_seq
+        else:
+            self.journal.append((self.signal_seq, apply_fn, args))
+
+    def _unapplied(self, apply_fn, args):
+        """
+        The part of a journaled signal the initial snapshot doesn't already
+        reflect, as arguments for apply_fn, or None if there is nothing left.
+        """
+        object_path = args[0]
+        have = self.objects.interfaces(object_path) \
+            if object_path in self.objects else ()
+
+        if apply_fn == self._do_obj_del:
+            present = [i for i in args[1] if i in have]
+            return (object_path, present) if present else None
+
+        if apply_fn == self._do_obj_add:
+            added = {i: p for i, p in args[1].items() if i not in have}
+            if not added:
+                return None
+            # set_object replaces the whole object
+            merged = self.objects.object(object_path) if have else dict()
+            merged.update(added)
+            return object_path, merged
+
+        object_path, interface, changed, invalid = args
+        if interface not in have:
+            return None
+        current = self.objects.properties(object_path, interface)
+        changed = {
+            prop: value
+            for prop, value in changed.items()
+            if prop not in current or current[prop] != _native(value)
+        }
+        if not changed and not invalid:
+            return None
+        return object_path, interface, changed, invalid
+
+    def _drain_journal(self):
+        # Signals received before the fetch was issued are in the snapshot.
+        # The ones received while it was outstanding may or may not be, so
+        # only what the snapshot doesn't already have is applied.
+        skipped = 0
+        applied = 0
+        while self.journal:
+            seq, apply_fn, args = self.journal.popleft()
+            if seq > self.fetch_seq:
+                args = self._unapplied(apply_fn, args)
+            else:
+                args = None
+            if args is None:
+                skipped += 1
+            else:
+                apply_fn(*args)
+                applied += 1
+            self.applied_seq = seq
+
+        if skipped or applied:
+            log(
+                "Journaled signals for %s, %d applied, %d already in the snapshot"
+                % (self, applied, skipped)
+            )
 
-        if objects:
+    def properties_changed(self, *args, **kwargs):
+        # The match rule should have the bus daemon doing this for us, but be
+        # certain.
+        if self.in_namespace(kwargs["object_path"]):
+            self.signals_used += 1
+            object_path = kwargs["object_path"]
+            interface = args[0]
+            changed = args[1]
+            invalid = args[2]
+
+            self._record("changed", object_path, interface, changed, invalid)
+            self.signal_counts["PropertiesChanged"] += 1
+
+            self._journal_signal(
+                self._do_prop_update, object_path, interface, changed, invalid
+            )
+
+    def _do_obj_add(self, object_path, interface_property_dict):
+        self.objects.set_object(object_path, interface_property_dict)
+        self._mark_dirty(object_path)
+        log_debug(
+            "SIGNAL: Object add: %s %s",
+            object_path,
+            _ObjectText(interface_property_dict),
+        )
 
-            # Handle all the pending, then this one
-            for pp in pending_update:
-                _do_prop_update(*pp)
+    def object_manager_add(self, object_path, payload):
+        self._record("add", object_path, payload)
+        self.signal_counts["InterfacesAdded"] += 1
+        self._journal_signal(self._do_obj_add, object_path, payload)
 
-            _do_prop_update(object_path, interface, changed, invalid)
+    def _do_obj_del(self, object_path, interfaces_removed):
+        self._mark_dirty(object_path)
+
+        if object_path in self.objects:
+            for intf in interfaces_removed:
+                log_debug("SIGNAL: Object interface deleted %s:%s", object_path, intf)
+
+            if self.objects.remove_interfaces(object_path, interfaces_removed):
+                log_debug("SIGNAL: Object del: %s", object_path)
         else:
-            pending_update.append((object_path, interface, changed, invalid))
+            log_error("Got a remove for object we don't have! %s" % object_path)
 
+    def object_manager_remove(self, object_path, payload):
+        self._record("remove", object_path, payload)
+        self.signal_counts["InterfacesRemoved"] += 1
+        self._journal_signal(self._do_obj_del, object_path, payload)
 
-def _do_obj_add(object_path, interface_property_dict):
-    global objects
-    objects[object_path] = interface_property_dict
-    log(" ")
-    log("SIGNAL: Object add: %s" % object_path)
-    dump_object(object_path, interface_property_dict)
+    def _object_manager(self):
+        obj_mgr = self.bus.get_object(self.bus_name, self.srv_path, introspect=False)
+        return dbus.Interface(obj_mgr, OBJECT_MANAGER)
 
+    def _get_managed_objects(self):
+        rc = dict()
+        obj_cur = self._object_manager().GetManagedObjects()
 
-def object_manager_add(object_path, payload):
-    global objects
-    global pending_add
-    global last_update
-    global dirty
+        for object_path, obj_value in obj_cur.items():
+            rc[object_path] = obj_value
 
-    last_update = time.time()
-    dirty = True
+        return rc
 
-    if initial_fetch_complete:
-        for adding in pending_add:
-            _do_obj_add(adding[0], adding[1])
+    def _get_managed_objects_async(self, reply_handler, error_handler):
+        self._object_manager().GetManagedObjects(
+            reply_handler=reply_handler,
+            error_handler=error_handler,
+            timeout=GET_MANAGED_OBJECTS_TIMEOUT,
+        )
 
-        _do_obj_add(object_path, payload)
-    else:
-        pending_add.append((object_path, payload))
+    def get_objects(self):
+        # Asynchronous so signals which arrive while the service builds the
+        # reply are dispatched, journaled after fetch_seq
+        owner = self.owner
+        self.fetch_seq = self.signal_seq
+
+        def _reply(objects):
+            # Not if the owner it came from has since gone away
+            if owner == self.owner:
+                self.initial_objects(objects)
+
+        def _error(err):
+            if owner == self.owner:
+                delay = self._backoff()
+                log(
+                    "%s GetManagedObjects failed: %s, retrying in %.1fs"
+                    % (self, str(err), delay)
+                )
+                GLib.timeout_add(int(delay * 1000), self.get_objects)
+
+        self._get_managed_objects_async(_reply, _error)
+        return False
+
+    def initial_objects(self, objects, fetch_seq=None):
+        self.retry_delay = 0
+        if fetch_seq is not None:
+            self.fetch_seq = fetch_seq
+        self._record("initial", objects, self.fetch_seq)
+        self.objects = SignalDb(objects)
+        self.initial_fetch_complete = True
+
+        # Anything which arrived while we were fetching gets applied once, in
+        # order
+        self._drain_journal()
+        if self.dirty:
+            self._arm_timer()
+
+    def _backoff(self):
+        self.retry_delay = min(RETRY_MAX, self.retry_delay * 2 or self.quiet_window())
+        return self.retry_delay
+
+    def request_full_sweep(self):
+        log("Full sweep requested for %s" % self)
+        self.full_sweep_requested = True
+        if not self.dirty:
+            self.dirty = True
+            self.dirty_since = time.time()
+        self._arm_timer()
+
+    def _compare_interface(self, object_path, interface, mgr_props, sig_props):
+        for prop in mgr_props.keys() - sig_props.keys():
+            log_error(
+                "Missing property %s for interface %s for object %s"
+                % (prop, interface, object_path)
+            )
 
+        # We shouldn't have any properties that the object manager doesn't have
+        extra = sig_props.keys() - mgr_props.keys()
+        if extra:
+            log_error(
+                "The following properties were present "
+                "in signals db which were not present in "
+                "object manager for object: %s" % object_path
+            )
+            for k in extra:
+                log("%s:%s" % (str(k), str(sig_props[k])))
+
+        for prop, value in mgr_props.items():
+            if prop not in sig_props:
+                continue
+
+            e = sig_props[prop]
+            # log("Comparing (%s): %s to %s" %
+            #      (prop, str(value), str(e)))
+            if value != e:
+                # Check to see if this property was invalidated!
+                key = object_path + interface
+                if not (key in self.invalidated and prop in self.invalidated[key]):
+                    log_error(
+                        "Property (%s) mismatch "
+                        "objectmgr %s !=  signal value: "
+                        "%s object: %s" % (prop, str(value), str(e), object_path)
+                    )
+                    # Dump objects
+                    log("Signal db")
+                    dump_object(object_path, self.objects.object(object_path))
+                    log("GetManagedObjects")
+                    dump_object(object_path, {interface: mgr_props})
+
+                # Fix up signal db to prevent reporting
+                # same error over and over again.
+                self.objects.update(object_path, interface, {prop: value})
+
+    def _compare_object(self, object_path, mgr_entry, interfaces=None):
+        sig_entry = self.objects.interfaces(object_path)
+
+        if interfaces is None:
+            interfaces = mgr_entry.keys() | sig_entry
+
+        for interface in interfaces:
+            if interface not in mgr_entry:
+                if interface in sig_entry:
+                    log_error(
+                        "The following interfaces were present in "
+                        "signals db which were not present in object"
+                        " manager for object %s" % object_path
+                    )
+                    log("interface %s for object %s" % (interface, object_path))
+            elif interface not in sig_entry:
+                log_error(
+                    "Missing interface %s for object %s" % (interface, object_path)
+                )
+            else:
+                self._compare_interface(
+                    object_path,
+                    interface,
+                    mgr_entry[interface],
+                    self.objects.properties(object_path, interface),
+                )
 
-def _do_obj_del(object_path, interfaces_removed):
-    global objects
+    def _validate_steps(self, c, full_sweep):
+        """
+        Generator doing the comparison one object at a time, yields between
+        objects so the caller can spread the work over several main loop
+        iterations.  Returns the number of objects compared.
+        """
+        root = 0
+        digests = dict()
+        for object_path, interfaces in c.items():
+            digests[object_path] = _fingerprint_object(interfaces)
+            root ^= _child_hash(object_path, digests[object_path][0])
+            yield
+
+        if root == self.objects.root and not full_sweep:
+            # Nothing to see here, everything matches
+            return 0
+
+        objects = self.objects.paths()
+
+        # Objects changed since the call was issued can legitimately differ
+        skip = self.in_flight_set.keys()
+
+        # Cheap check on the set of object paths first
+        for object_path in c.keys() - objects - skip:
+            log_error("Missing object %s" % object_path)
+
+        # We shouldn't have any objects left
+        extra = objects - c.keys() - skip
+        if extra:
+            log_error(
+                "The following objects were present in signals db which "
+                "were not preset in object manager"
+            )
+            for objs in extra:
+                log_error("%s" % str(objs))
+
+        checked = 0
+        for object_path in c.keys() & objects - skip:
+            yield
+
+            # Signals are processed between slices, so check again
+            if object_path in self.in_flight_set or object_path not in self.objects:
+                continue
+
+            interfaces = None
+            if not full_sweep:
+                # Follow the tree down to the objects and interfaces which
+                # differ
+                obj_digest, intf_digests = digests[object_path]
+                if obj_digest == self.objects.object_digest(object_path):
+                    continue
+
+                sig_interfaces = self.objects.interfaces(object_path)
+                interfaces = set()
+                for interface in intf_digests.keys() | sig_interfaces:
+                    if (
+                        interface not in intf_digests
+                        or interface not in sig_interfaces
+                        or intf_digests[interface]
+                        != self.objects.interface_digest(object_path, interface)
+                    ):
+                        interfaces.add(interface)
+
+            self._compare_object(object_path, c[object_path], interfaces)
+            checked += 1
+
+        return checked
+
+    def _validation_done(self):
+        # Whatever changed while we were waiting on the reply still needs
+        # checking
+        if self.in_flight_set and not self.dirty:
+            self.dirty = True
+            self.dirty_since = time.time()
+        self.in_flight_set = dict()
+        self.validation_in_flight = False
+        self.validation_steps = None
+        if self.dirty:
+            self._arm_timer()
+
+    def _validation_reply(self, c):
+        if not self.validation_in_flight:
+            # Owner changed while the call was outstanding
+            return
+        self._record("reply", c)
+        self.retry_delay = 0
+
+        self.validation_reply = c
+        self.validation_steps = self._validate_steps(c, self.validation_full_sweep)
+        self.validation_slices = 0
+        self.validation_max_slice = 0
+
+        if sliced_validation:
+            # Idle priority, pending signals are dispatched ahead of us
+            GLib.idle_add(self._validation_slice)
+        else:
+            while self._validation_slice():
+                pass
 
-    if object_path in objects:
-        for intf in interfaces_removed:
-            del objects[object_path][intf]
-            log("SIGNAL: Object interface deleted %s:%s" % (object_path, intf))
+    def _validation_slice(self):
+        if self.validation_steps is None:
+            # Abandoned by an owner change
+            return False
+        start = time.time()
+        done = False
+        checked = 0
+        try:
+            for _ in range(VALIDATION_SLICE_OBJECTS):
+                next(self.validation_steps)
+                if time.time() - start > VALIDATION_SLICE_TIME:
+                    break
+        except StopIteration as e:
+            done = True
+            checked = e.value
+        except:
+            log_exception("%s validation failed", self)
+            self.invalidated = dict()
+            self._validation_done()
+            return False
 
-        if not objects[object_path]:
-            del objects[object_path]
-            log("SIGNAL: Object del: %s" % object_path)
-    else:
-        log_error("Got a remove for object we don't have! %s" % object_path)
+        self.validation_slices += 1
+        self.validation_max_slice = max(self.validation_max_slice, time.time() - start)
+
+        if not done:
+            return True
 
+        c = self.validation_reply
+        self.validation_reply = None
+        self._observe_validation(time.time() - self.validation_start)
 
-def object_manager_remove(object_path, payload):
+        if errors > 0:
+            log_error(
+                "Validating objects %s exiting ON ERROR! duration = %f"
+                % (self, time.time() - self.validation_start)
+            )
 
-    global objects
-    global pending_rm
-    global last_update
-    global dirty
+            # Delay the end of the test to see if whatever is incorrect
+            # resolves itself.
+            if not replaying:
+                GLib.timeout_add(500, kill_test)
+        else:
+            log(
+                "Validating objects %s exit %f (%d of %d objects compared, "
+                "%d skipped as changed in flight, snapshot seq %d..%d, "
+                "%d slices, longest %f, main loop max stall %f, "
+                "PropertiesChanged used %d%s)"
+                % (
+                    self,
+                    time.time() - self.validation_start,
+                    checked,
+                    len(c),
+                    len(self.in_flight_set),
+                    self.validation_seq,
+                    self.applied_seq,
+                    self.validation_slices,
+                    self.validation_max_slice,
+                    max_loop_stall,
+                    self.signals_used,
+                    _unfiltered_note(),
+                )
+            )
 
-    last_update = time.time()
-    dirty = True
+        # Clear out invalidated
+        self.invalidated = dict()
+        self._validation_done()
+        return False
+
+    def _observe_validation(self, duration):
+        self.validation_count_done += 1
+        self.validation_sum += duration
+        for i, le in enumerate(VALIDATION_BUCKETS):
+            if duration <= le:
+                self.validation_buckets[i] += 1
+
+    def metrics(self):
+        """
+        Prometheus samples for this monitor as (metric family, text line),
+        metrics_text groups them by family across monitors.
+        """
+        label = 'service="%s"' % self
+        rc = []
+        for kind in ("InterfacesAdded", "InterfacesRemoved", "PropertiesChanged"):
+            rc.append(
+                (
+                    "oversight_signals_total",
+                    'oversight_signals_total{%s,type="%s"} %d'
+                    % (label, kind, self.signal_counts[kind]),
+                )
+            )
+        for family, value in (
+            ("oversight_properties_changed_used_total", self.signals_used),
+            ("oversight_journal_depth", len(self.journal)),
+            ("oversight_sequence", self.signal_seq),
+            ("oversight_in_flight_objects", len(self.in_flight_set)),
+            ("oversight_objects", len(self.objects)),
+            ("oversight_properties", self.objects.property_count),
+        ):
+            rc.append((family, "%s{%s} %d" % (family, label, value)))
+
+        family = "oversight_validation_duration_seconds"
+        for le, count in zip(VALIDATION_BUCKETS, self.validation_buckets):
+            rc.append(
+                (family, '%s_bucket{%s,le="%s"} %d' % (family, label, le, count))
+            )
+        rc.append(
+            (
+                family,
+                '%s_bucket{%s,le="+Inf"} %d'
+                % (family, label, self.validation_count_done),
+            )
+        )
+        rc.append((family, "%s_sum{%s} %f" % (family, label, self.validation_sum)))
+        rc.append(
+            (family, "%s_count{%s} %d" % (family, label, self.validation_count_done))
+        )
+        return rc
+
+    def _validation_error(self, err):
+        if not self.validation_in_flight:
+            return
+        self._record("reply_error", str(err))
+        delay = self._backoff()
+        self.retry_at = time.time() + delay
+        log(
+            "Validating objects %s GetManagedObjects failed: %s, retrying in %.1fs"
+            % (self, str(err), delay)
+        )
 
-    if initial_fetch_complete:
-        for p in pending_rm:
-            _do_obj_del(p[0], p[1])
+        # Nothing was checked, try again later
+        self.in_flight_set.clear()
+        if not self.dirty:
+            self.dirty = True
+            self.dirty_since = time.time()
+        self.validation_in_flight = False
+        self._arm_timer(delay)
+
+    def begin_validation(self, full_sweep_requested=None, forced=False):
+        if full_sweep_requested is not None:
+            self.full_sweep_requested = full_sweep_requested
+
+        self._record("validate", self.full_sweep_requested)
+
+        self.validation_start = time.time()
+        self.validation_count += 1
+        self.validation_full_sweep = self.full_sweep_requested or (
+            FULL_SWEEP_INTERVAL > 0
+            and self.validation_count % FULL_SWEEP_INTERVAL == 0
+        )
+        log(
+            "Validating objects %s entry (full sweep = %s, quiet window %f%s)"
+            % (
+                self,
+                self.validation_full_sweep,
+                self.quiet_window(),
+                ", forced under load at seq %d" % self.applied_seq if forced else "",
+            )
+        )
 
-        _do_obj_del(object_path, payload)
-    else:
-        pending_rm.append((object_path, payload))
+        self.dirty = False
+        self.full_sweep_requested = False
 
+        self.validation_in_flight = True
+        self.validation_seq = self.applied_seq
+        _start_heartbeat()
 
-def _get_managed_objects(the_bus):
-    rc = dict()
-    obj_mgr = the_bus.get_object(BUS_NAME, SRV_PATH, introspect=False)
-    obj_int = dbus.Interface(obj_mgr, OBJECT_MANAGER)
-    obj_cur = obj_int.GetManagedObjects()
 
-    for object_path, obj_value in obj_cur.items():
-        rc[object_path] = obj_value
+def heartbeat():
+    global max_loop_stall
+    global last_heartbeat
+    global heartbeat_id
 
-    return rc
+    if not any(m.validation_in_flight for m in monitors):
+        last_heartbeat = 0
+        heartbeat_id = None
+        return False
+
+    now = time.time()
+    if last_heartbeat:
+        max_loop_stall = max(max_loop_stall, now - last_heartbeat - HEARTBEAT_MS / 1000.0)
+    last_heartbeat = now
+    return True
+
+
+def _start_heartbeat():
+    global heartbeat_id
+
+    if heartbeat_id is None and not replaying:
+        heartbeat_id = GLib.timeout_add(HEARTBEAT_MS, heartbeat)
+
+
+def _rss_bytes():
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+
+# Every metric family in output order with its type, the text format wants
+# all the samples of a family together after its TYPE line.
+METRIC_FAMILIES = [
+    ("oversight_signals_total", "counter"),
+    ("oversight_properties_changed_used_total", "counter"),
+    ("oversight_journal_depth", "gauge"),
+    ("oversight_sequence", "gauge"),
+    ("oversight_in_flight_objects", "gauge"),
+    ("oversight_objects", "gauge"),
+    ("oversight_properties", "gauge"),
+    ("oversight_validation_duration_seconds", "histogram"),
+    ("oversight_properties_changed_unfiltered_total", "counter"),
+    ("oversight_errors_total", "counter"),
+    ("oversight_main_loop_max_stall_seconds", "gauge"),
+    ("oversight_resident_memory_bytes", "gauge"),
+]
+
+
+def metrics_text():
+    samples = collections.defaultdict(list)
+    for m in monitors:
+        for family, line in m.metrics():
+            samples[family].append(line)
+
+    for family, fmt, value in (
+        ("oversight_errors_total", "%d", errors),
+        ("oversight_main_loop_max_stall_seconds", "%f", max_loop_stall),
+        ("oversight_resident_memory_bytes", "%d", _rss_bytes()),
+    ):
+        samples[family].append(("%s " + fmt) % (family, value))
+
+    if measure_unfiltered:
+        family = "oversight_properties_changed_unfiltered_total"
+        samples[family].append("%s %d" % (family, signals_unfiltered))
+
+    rc = []
+    for family, kind in METRIC_FAMILIES:
+        if samples[family]:
+            rc.append("# TYPE %s %s" % (family, kind))
+            rc.extend(samples[family])
+    return "\n".join(rc) + "\n"
+
+
+def write_metrics():
+    # Write and rename so a scraper never sees a partial file
+    tmp = metrics_file + ".tmp"
+    try:
+        with open(tmp, "w") as f:
+            f.write(metrics_text())
+        os.rename(tmp, metrics_file)
+    except OSError as e:
+        log("Unable to write metrics %s: %s" % (metrics_file, str(e)))
+    return True
+
+
+def _metrics_request(conn, condition):
+    try:
+        conn.recv(4096)
+        body = metrics_text().encode("utf-8")
+        conn.sendall(
+            b"HTTP/1.0 200 OK\r\n"
+            b"Content-Type: text/plain; version=0.0.4\r\n"
+            + ("Content-Length: %d\r\n\r\n" % len(body)).encode("utf-8")
+            + body
+        )
+    except OSError as e:
+        log("Metrics request failed: %s" % str(e))
+    finally:
+        conn.close()
+    return False
+
+
+def _metrics_accept(sock, condition):
+    try:
+        conn, _ = sock.accept()
+    except OSError:
+        return True
+    conn.settimeout(1.0)
+    GLib.io_add_watch(conn, GLib.PRIORITY_DEFAULT, GLib.IO_IN, _metrics_request)
+    return True
+
+
+def serve_metrics(port):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("127.0.0.1", port))
+    sock.listen(8)
+    sock.setblocking(False)
+    GLib.io_add_watch(sock, GLib.PRIORITY_DEFAULT, GLib.IO_IN, _metrics_accept)
+    return sock
 
 
 def process_pid(name):
@@ -237,206 +1758,261 @@ def kill_test():
     if pid:
         os.kill(pid, 9)
 
+    if recorder:
+        recorder.close()
+
     dump()
     sys.exit(5)
 
 
-def get_objects(the_bus):
-    global objects
-    global initial_fetch_complete
-    objects = _get_managed_objects(the_bus)
-    initial_fetch_complete = True
-
-
-def check_idle():
-    global last_update
-    global dirty
-    global invalidated
+def request_full_sweep():
+    for m in monitors:
+        m.request_full_sweep()
+    return True
 
-    current = time.time()
-    time_since_last_signal = current - last_update
 
-    # It's difficult to determine that any given state is correct if things are
-    # rapidly changing.  We will wait until we haven't gotten any signals for
-    # a while and we will then compare what the object manager retrieves vs.
-    # what we have gotten via signals.  They should match if all the signals
-    # are being delivered as needed.
-    if dirty and time_since_last_signal > 3.0 and objects is not None:
+def _replay_record(replay_monitors, record):
+    kind, _, service, data = record
+
+    m = replay_monitors.get(service)
+    if m is None:
+        bus_name, srv_path = service.split(":", 1)
+        m = ServiceMonitor(None, bus_name, srv_path)
+        replay_monitors[service] = m
+        monitors.append(m)
+
+    if kind == "initial":
+        m.initial_objects(*data)
+    elif kind == "add":
+        m.object_manager_add(*data)
+    elif kind == "remove":
+        m.object_manager_remove(*data)
+    elif kind == "changed":
+        m.properties_changed(*data[1:], object_path=data[0])
+    elif kind == "validate":
+        m.begin_validation(*data)
+    elif kind == "reply":
+        m._validation_reply(*data)
+    elif kind == "reply_error":
+        m._validation_error(*data)
+    elif kind == "owner":
+        m._owner_changed(*data)
+    else:
+        log("Unknown record type %s" % kind)
+
+
+def replay(file_name, fast):
+    """
+    Feed a recording through the monitors, as fast as possible or by using
+    the main loop to reproduce the original timing.
+    """
+    global replaying
+    global sliced_validation
+
+    replaying = True
+    # Without a main loop there is nobody to run the slices
+    sliced_validation = not fast
+    replay_monitors = dict()
+    records = read_records(file_name)
+    start = time.time()
+    count = 0
+
+    if fast:
+        for r in records:
+            _replay_record(replay_monitors, r)
+            count += 1
+    else:
+        loop = GLib.MainLoop()
+        first = next(records, None)
+        if first is None:
+            return 0
+        base = first[1]
         start = time.time()
-        log("Validating objects entry")
 
-        last_update = current
-        dirty = False
+        def _finish():
+            # Let any validation still in progress complete
+            if any(m.validation_steps for m in monitors):
+                return True
+            loop.quit()
+            return False
 
-        try:
-            sys_bus = dbus.SystemBus()
-            c = _get_managed_objects(sys_bus)
-            p = copy.deepcopy(objects)  # Make full copy of signal DB
-
-            # Compare what we just retrieved to what we have gotten via signals
-            for object_path, entry in c.items():
-                if object_path not in p:
-                    log_error("Missing object %s" % object_path)
-                else:
-                    for interface, prop_vals in entry.items():
-                        if interface not in p[object_path]:
-                            log_error(
-                                "Missing interface %s for object %s"
-                                % (interface, object_path)
-                            )
-                        else:
-                            for prop, value in prop_vals.items():
-                                if prop not in c[object_path][interface]:
-                                    log_error(
-                                        "Missing property %s for interface "
-                                        "%s for object %s"
-                                        % (prop, interface, object_path)
-                                    )
-                                else:
-                                    e = p[object_path][interface][prop]
-                                    # log("Comparing (%s): %s to %s" %
-                                    #      (prop, str(value), str(e)))
-                                    if value != e:
-                                        # Check to see if this property was invalidated!
-                                        key = object_path + interface
-                                        if not (
-                                            key in invalidated
-                                            and prop in invalidated[key]
-                                        ):
-                                            log_error(
-                                                "Property (%s) mismatch "
-                                                "objectmgr %s !=  signal value: "
-                                                "%s object: %s"
-                                                % (
-                                                    prop,
-                                                    str(value),
-                                                    str(e),
-                                                    object_path,
-                                                )
-                                            )
-                                            # Dump objects
-                                            log("Signal db")
-                                            dump_object(
-                                                object_path, objects[object_path]
-                                            )
-                                            log("GetManagedObjects")
-                                            dump_object(object_path, c[object_path])
-
-                                        # Fix up signal db to prevent reporting
-                                        # same error over and over again.
-                                        objects[object_path][interface][prop] = value
-
-                                    # Regardless of comparison, we will remove
-                                    # property from signal db copy so we don't
-                                    # get false error about it still being
-                                    # present when done.
-                                    del p[object_path][interface][prop]
-
-                            # We shouldn't have any properties left
-                            if p[object_path][interface]:
-                                log_error(
-                                    "The following properties were present "
-                                    "in signals db which were not present in "
-                                    "object manager for object: %s" % object_path
-                                )
-                                for k, v in p[object_path][interface].items():
-                                    log("%s:%s" % (str(k), str(v)))
-
-                            del p[object_path][interface]
-
-                    # We shouldn't have any interfaces left
-                    if p[object_path]:
-                        log_error(
-                            "The following interfaces were present in "
-                            "signals db which were not present in object"
-                            " manager for object %s" % object_path
-                        )
-                        for intf in p[object_path].keys():
-                            log("interface %s for object %s" % (intf, object_path))
-                    del p[object_path]
-
-            # We shouldn't have any objects left
-            if p:
-                log_error(
-                    "The following objects were present in signals db which "
-                    "were not preset in object manager"
-                )
-                for objs in p.keys():
-                    log_error("%s" % str(objs))
-        except:
-            traceback.print_exc()
+        def _next(record):
+            nonlocal count
+            _replay_record(replay_monitors, record)
+            count += 1
+
+            record = next(records, None)
+            if record is None:
+                GLib.idle_add(_finish)
+            else:
+                delay = (record[1] - base) - (time.time() - start)
+                GLib.timeout_add(max(0, int(delay * 1000)), _next, record)
             return False
 
-        if errors > 0:
-            log_error(
-                "Validating objects exiting ON ERROR! duration = %f"
-                % (time.time() - start)
-            )
+        GLib.idle_add(_next, first)
+        loop.run()
 
-            # Delay the end of the test to see if whatever is incorrect resolves
-            # itself.
-            GLib.timeout_add(500, kill_test)
-            return False
-        else:
-            log("Validating objects exit %f" % (time.time() - start))
+    log(
+        "Replayed %d records in %f seconds, errors = %d"
+        % (count, time.time() - start, errors)
+    )
+    return count
 
-        # Clear out invalidated
-        invalidated = dict()
 
-    return True
+def parse_services(args):
+    rc = []
+    for a in args:
+        fields = a.split(":")
+        if len(fields) not in (2, 3) or not fields[1].startswith("/"):
+            raise ValueError("Invalid service %s" % a)
+        rc.append((fields[0], fields[1], fields[2] if len(fields) == 3 else None))
+    return rc
 
 
 if __name__ == "__main__":
 
-    if len(sys.argv) > 1 and len(sys.argv) != 3:
-        log(
-            "syntax: None or bus_name path, eg. %s %s %s"
-            % (sys.argv[0], BUS_NAME, SRV_PATH)
-        )
+    parser = argparse.ArgumentParser(
+        description="Verify dbus object manager signals against GetManagedObjects"
+    )
+    parser.add_argument(
+        "services",
+        nargs="*",
+        help="bus_name:path[:arg0namespace], default %s:%s" % (BUS_NAME, SRV_PATH),
+    )
+    parser.add_argument("--record", metavar="FILE", help="record the signal stream")
+    parser.add_argument(
+        "--replay", metavar="FILE", help="replay a recording instead of using the bus"
+    )
+    parser.add_argument(
+        "--log-level",
+        choices=sorted(LOG_LEVELS, key=LOG_LEVELS.get),
+        default="info",
+        help="records below this level only go to the ring buffer",
+    )
+    parser.add_argument(
+        "--log-format", choices=("text", "json"), default="text", help="log output"
+    )
+    parser.add_argument(
+        "--log-ring",
+        metavar="N",
+        type=int,
+        default=1000,
+        help="recent records written as context on error, default 1000",
+    )
+    parser.add_argument(
+        "--metrics-file",
+        metavar="FILE",
+        help="periodically write Prometheus text format metrics to FILE",
+    )
+    parser.add_argument(
+        "--measure-unfiltered",
+        action="store_true",
+        help="also add the broad PropertiesChanged rule add_signal_receiver "
+        "would use and count what it delivers, to measure what the narrow "
+        "match rules save",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        metavar="PORT",
+        type=int,
+        help="serve Prometheus text format metrics on localhost:PORT",
+    )
+    parser.add_argument(
+        "--metrics-interval",
+        metavar="SECONDS",
+        type=int,
+        default=10,
+        help="how often to rewrite the metrics file, default 10",
+    )
+    parser.add_argument(
+        "--memory-report",
+        metavar="N",
+        type=int,
+        help="compare signal db memory use for N synthetic objects and exit",
+    )
+    parser.add_argument(
+        "--self-test",
+        action="store_true",
+        help="check the fingerprints tell apart values that are easy to "
+        "confuse and exit",
+    )
+    parser.add_argument(
+        "--fast",
+        action="store_true",
+        help="replay as fast as possible instead of the original timing",
+    )
+    args = parser.parse_args()
+
+    logger.level = LOG_LEVELS[args.log_level]
+    logger.json_lines = args.log_format == "json"
+    logger.resize_ring(args.log_ring)
+    atexit.register(logger.flush)
+
+    if args.memory_report:
+        memory_report(args.memory_report)
+        sys.exit(0)
+
+    if args.self_test:
+        try:
+            check_fingerprints()
+        except AssertionError as e:
+            log_error(str(e))
+            sys.exit(1)
+        log("Fingerprint self test passed")
+        sys.exit(0)
+
+    if args.replay:
+        replay(args.replay, args.fast)
+        sys.exit(5 if errors > 0 else 0)
+
+    try:
+        services = parse_services(args.services)
+    except ValueError as e:
+        log(str(e))
+        parser.print_usage()
         sys.exit(1)
-    elif len(sys.argv) == 3:
-        BUS_NAME = sys.argv[1]
-        SRV_PATH = sys.argv[2]
+
+    if not services:
+        services = [(BUS_NAME, SRV_PATH, None)]
+
+    if args.record:
+        recorder = Recorder(args.record)
 
     dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
     bus = dbus.SystemBus()
     try:
-        # Register for main signals
-        dobj = bus.get_object(BUS_NAME, SRV_PATH)
-        dobj.connect_to_signal(
-            dbus_interface=OBJECT_MANAGER,
-            signal_name="InterfacesAdded",
-            handler_function=object_manager_add,
-        )
+        bus.add_message_filter(_properties_filter)
+        if args.measure_unfiltered:
+            measure_unfiltered = True
+            bus.add_match_string_non_blocking(UNFILTERED_PROPERTIES_RULE)
 
-        dobj.connect_to_signal(
-            dbus_interface=OBJECT_MANAGER,
-            signal_name="InterfacesRemoved",
-            handler_function=object_manager_remove,
-        )
+        for bus_name, srv_path, arg0namespace in services:
+            m = ServiceMonitor(bus, bus_name, srv_path, arg0namespace)
+            monitors.append(m)
+            m.start()
 
-        bus.add_signal_receiver(
-            properties_changed,
-            signal_name="PropertiesChanged",
-            path_keyword="object_path",
-        )
+        GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGUSR1, request_full_sweep)
 
-        # There is an inherent race condition between fetching all the objects
-        # and having the signal handlers in place.  We will install signal
-        # handlers and schedule the object retrieval to occur when the main
-        # event loop is idle.  This way the main loop is up and processing
-        # events before we retrieve the entire object state.
-        GLib.idle_add(get_objects, bus)
-        GLib.timeout_add(500, check_idle)
+        if args.metrics_file:
+            metrics_file = args.metrics_file
+            GLib.timeout_add_seconds(args.metrics_interval, write_metrics)
+        if args.metrics_port:
+            metrics_sock = serve_metrics(args.metrics_port)
 
         loop = GLib.MainLoop()
         loop.run()
     except KeyboardInterrupt:
-        log("Exiting on ^C")
+        log(
+            "Exiting on ^C, PropertiesChanged used %d%s"
+            % (sum(m.signals_used for m in monitors), _unfiltered_note())
+        )
+        if recorder:
+            log("Recorded %d records to %s" % (recorder.count, args.record))
+            recorder.close()
         # dump()
         if errors > 0:
             sys.exit(5)
         sys.exit(0)
     except BaseException:
-        traceback.print_exc()
+        log_exception("Exiting on unexpected exception")
         sys.exit(1)